@@ -1,20 +1,29 @@
 import logging
+import multiprocessing
 import os
 import re
 import ssl
+import threading
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from enum import Enum
+from functools import partial, wraps
+from itertools import islice
 
+import orjson
 import pandas as pd
 import requests
 import sentry_sdk
 import urllib3
-from flask import Flask, jsonify, make_response, request, Response
+from flask import Flask, jsonify, make_response, request, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_swagger import swagger
 from flask_swagger_ui import get_swaggerui_blueprint
 from sentry_sdk.integrations.flask import FlaskIntegration
-from sqlalchemy import func, or_
+from sqlalchemy import bindparam, func, or_
+from werkzeug.http import generate_etag
 
 import common_queries as cq
 import spectrum
@@ -41,10 +50,18 @@ def get_legacy_session():
     ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
     ctx.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
     session = requests.session()
-    session.mount('https://', CustomHttpAdapter(ctx))
+    session.mount('https://', CustomHttpAdapter(ctx, pool_maxsize=CCTE_API_POOL_SIZE))
     return session
 
 
+# A single session is shared across requests so that connections to the CCTE API are kept alive and
+# reused, instead of paying for a new TCP connection and TLS handshake on every call.  The pool
+# keeps enough connections open for every server thread to have one.
+CCTE_API_POOL_SIZE = int(os.environ.get('AMOS_CCTE_API_POOL_SIZE', 20))
+CCTE_API_TIMEOUT = float(os.environ.get('AMOS_CCTE_API_TIMEOUT', 10))
+legacy_session = get_legacy_session()
+
+
 # Integrating Sentry into Amos
 sentry_sdk.init(
     dsn="https://712871757f0243ee8370d9558bfff1ac@ccte-app-monitoring.epa.gov/13",
@@ -61,8 +78,51 @@ sentry_sdk.init(
 # Load connection info for PostgreSQL & API access
 ccte_api_server = os.environ['CCTE_API_SERVER']
 ccte_api_key = os.environ['CCTE_API_KEY']
+SIMILAR_SUBSTANCE_CACHE_TTL = int(os.environ.get('AMOS_SIMILAR_SUBSTANCE_CACHE_TTL', 86400))
+IMAGE_MAX_AGE = int(os.environ.get('AMOS_IMAGE_MAX_AGE', 86400))
+IMAGE_CACHE_SIZE = int(os.environ.get('AMOS_IMAGE_CACHE_SIZE', 256))
+LIST_MAX_AGE = int(os.environ.get('AMOS_LIST_MAX_AGE', 300))
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider that serializes responses with orjson, which is considerably
+    faster than the standard library on the large, deeply nested results some
+    endpoints return and handles numpy values natively.  Date formatting
+    matches Flask's default provider, and keys are only sorted if sort_keys is
+    set.  Output is compact unless `indent` is passed to dumps() (orjson only
+    indents by two spaces) or, for responses, `compact` is False or debug mode
+    is on, as with Flask's own provider.  Any other json.dumps() arguments are
+    handed to the default provider instead.
+    """
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    orjson_arguments = {"indent", "sort_keys"}
+
+    def dumps(self, obj, **kwargs):
+        if not self.orjson_arguments.issuperset(kwargs):
+            return super().dumps(obj, **kwargs)
+        return self.orjson_dumps(obj, **kwargs).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def orjson_dumps(self, obj, indent=None, sort_keys=None):
+        option = self.option
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=option)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self.orjson_dumps(obj, indent=indent), mimetype=self.mimetype)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# sorting every object's keys costs time on large responses and clients don't rely on the order
+app.json.sort_keys = False
 
 
 @app.get('/api/amos/swagger.json')
@@ -97,12 +157,119 @@ else:
     app.config["SQLALCHEMY_DATABASE_URI"] = f"postgresql+psycopg2://{uname}:{pwd}@{server}:{port}/{database}"
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_size": int(os.environ.get('AMOS_DB_POOL_SIZE', 20)),
+    "max_overflow": int(os.environ.get('AMOS_DB_MAX_OVERFLOW', 40)),
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+    "pool_use_lifo": True,
+    "query_cache_size": 5000
+}
 app.secret_key = "secretkey"
 
 
 CORS(app, resources={r'/*': {'origins': '*'}})
 
 
+def cached_response(function):
+    """
+    Decorator for GET endpoints without arguments that return large, rarely
+    changing results.  The serialized response body and its ETag are kept in the TTL cache, so
+    repeat requests skip both the database and JSON serialization, and clients
+    revalidating with If-None-Match get an empty 304 response instead of the
+    whole result again.
+    """
+    @util.ttl_cache(max_entries=1)
+    def cached_body(*args, **kwargs):
+        body = app.make_response(function(*args, **kwargs)).get_data()
+        return body, generate_etag(body)
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        body, etag = cached_body(*args, **kwargs)
+        response = app.response_class(body, mimetype=app.json.mimetype)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = LIST_MAX_AGE
+        return response.make_conditional(request)
+
+    return wrapper
+
+
+# Statements for the simple lookup-by-ID endpoints are built once here and reused with bound
+# parameters, rather than being rebuilt on every request.
+INFO_BY_ID_QUERY = db.select(
+    RecordInfo.internal_id, RecordInfo.methodologies, RecordInfo.source, RecordInfo.link, RecordInfo.experimental,
+    RecordInfo.external_use_allowed, RecordInfo.description, RecordInfo.data_type, RecordInfo.record_type
+).filter(RecordInfo.internal_id == bindparam("internal_id"))
+MASS_SPECTRUM_QUERY = db.select(
+    MassSpectra.spectrum, MassSpectra.splash, MassSpectra.normalized_entropy, MassSpectra.spectral_entropy,
+    MassSpectra.has_associated_method, MassSpectra.spectrum_metadata
+).filter(MassSpectra.internal_id == bindparam("internal_id"))
+NMR_SPECTRUM_QUERY = db.select(
+    NMRSpectra.intensities, NMRSpectra.first_x, NMRSpectra.last_x, NMRSpectra.x_units,
+    NMRSpectra.frequency, NMRSpectra.nucleus, NMRSpectra.temperature, NMRSpectra.solvent,
+    NMRSpectra.spectrum_metadata
+).filter(NMRSpectra.internal_id == bindparam("internal_id"))
+IR_SPECTRUM_QUERY = db.select(
+    InfraredSpectra.first_x, InfraredSpectra.intensities, InfraredSpectra.ir_type,
+    InfraredSpectra.laser_frequency, InfraredSpectra.last_x, InfraredSpectra.spectrum_metadata
+).filter(InfraredSpectra.internal_id == bindparam("internal_id"))
+SUBSTANCE_IMAGE_QUERY = db.select(SubstanceImages.png_image).filter(SubstanceImages.dtxsid == bindparam("dtxsid"))
+
+
+# Spectrum similarity scoring is CPU-bound, so large similarity searches are spread across a pool
+# of worker processes.  The pool is kept small by default, since a container's CPU count is often
+# the host's; setting AMOS_SIMILARITY_WORKERS to 1 keeps all scoring in the request thread.
+SIMILARITY_BATCH_SIZE = 256
+if hasattr(os, "sched_getaffinity"):
+    available_cpus = len(os.sched_getaffinity(0))
+else:
+    available_cpus = os.cpu_count() or 1
+similarity_workers = int(os.environ.get('AMOS_SIMILARITY_WORKERS', min(4, available_cpus)))
+similarity_executor_lock = threading.Lock()
+
+
+def make_similarity_executor():
+    """
+    Starts the worker process pool for similarity scoring, or returns None if scoring should
+    happen in the request thread.
+    """
+    if similarity_workers > 1:
+        return ProcessPoolExecutor(max_workers=similarity_workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        return None
+
+
+similarity_executor = make_similarity_executor()
+
+
+def map_similarity_scoring(function, *iterables):
+    """
+    Maps a spectrum scoring function over its arguments, using the worker process pool if there
+    is one.  Results are returned in the same order as the arguments, which should be lists.
+
+    Each worker is handed one contiguous share of the spectra, so the scoring function (and the
+    user spectra bound to it) is only sent to each worker once per call.  If the pool has broken
+    (e.g., a worker was killed for running out of memory), it's replaced with a fresh one and
+    this call's scoring is done in the request thread instead.
+    """
+    global similarity_executor
+    executor = similarity_executor
+    if executor is None:
+        return list(map(function, *iterables))
+    chunksize = max(-(-len(iterables[0]) // similarity_workers), 1)
+    try:
+        return list(executor.map(function, *iterables, chunksize=chunksize))
+    except BrokenProcessPool:
+        logging.exception("Similarity worker pool broke; restarting it")
+        with similarity_executor_lock:
+            if similarity_executor is executor:
+                similarity_executor = make_similarity_executor()
+        executor.shutdown(wait=False)
+        return list(map(function, *iterables))
+
+
 # TODO (2025-03-07): If paginated endpoints for the methods and fact sheets are working after a
 # month without complaints, delete the old endpoints.
 
@@ -114,6 +281,13 @@ class SearchType(Enum):
     DTXSID = 4
 
 
+# One alternative per structured identifier, tried in order; each group is named after its
+# SearchType member.  Anything that doesn't match is treated as a substance name.
+SEARCH_TYPE_REGEX = re.compile(
+    "(?P<CASRN>[0-9]*-[0-9]*-[0-9])|(?P<InChIKey>[A-Z]{14}-[A-Z]{8}[SN][A-Z]-[A-Z]$)|(?P<DTXSID>DTXSID[0-9]*)"
+)
+
+
 def determine_search_type(search_term):
     """
     Determine whether the search term in question is an InChIKey, CAS number, or a name.
@@ -127,12 +301,9 @@ def determine_search_type(search_term):
 
     """
 
-    if re.match("^[0-9]*-[0-9]*-[0-9]", search_term.strip()):
-        return SearchType.CASRN
-    elif re.match("^[A-Z]{14}-[A-Z]{8}[SN][A-Z]-[A-Z]$", search_term.strip()):
-        return SearchType.InChIKey
-    elif re.match("DTXSID[0-9]*", search_term.strip()):
-        return SearchType.DTXSID
+    match = SEARCH_TYPE_REGEX.match(search_term.strip())
+    if match:
+        return SearchType[match.lastgroup]
     else:
         return SearchType.SubstanceName
 
@@ -171,14 +342,16 @@ def get_substances_for_search_term(search_term):
             substances = results[0].get_row_contents()
 
     elif search_type == SearchType.SubstanceName:
-        q_name = q.filter(Substances.preferred_name.ilike(search_term))
+        # case-insensitive equality rather than ILIKE, so it can use an index on lower(preferred_name)
+        # and '%' or '_' in the term aren't treated as wildcards
+        q_name = q.filter(func.lower(Substances.preferred_name) == func.lower(search_term))
         results = db.session.execute(q_name).first()
         # if no matches, check if it's a synonym
         if results:
             substances = results[0].get_row_contents()
         else:
             q_syn = q.join_from(Synonyms, Substances, Synonyms.dtxsid == Substances.dtxsid).filter(
-                Synonyms.synonym.ilike(search_term))
+                func.lower(Synonyms.synonym) == func.lower(search_term))
             synonym_results = db.session.execute(q_syn).all()
             if len(synonym_results) == 1:
                 substances = synonym_results[0][0].get_row_contents()
@@ -188,8 +361,7 @@ def get_substances_for_search_term(search_term):
 
     elif search_type == SearchType.InChIKey:
         results = cq.inchikey_first_block_search(search_term[:14])
-        inchikey_present = any([r["jchem_inchikey"] == search_term for r in results]) or any(
-            [r["indigo_inchikey"] == search_term for r in results])
+        inchikey_present = any(search_term in (r["jchem_inchikey"], r["indigo_inchikey"]) for r in results)
         if inchikey_present and len(results) == 1:
             substances = results[0]
         elif len(results) > 0:
@@ -225,55 +397,43 @@ def search_results(dtxsid):
         description: A JSON object containing a list of records from the database and counts of records by record type.
     """
 
-    id_query = db.select(Contents.internal_id).filter(Contents.dtxsid == dtxsid)
-    internal_ids = [ir.internal_id for ir in db.session.execute(id_query).all()]
-
+    # method numbers and mass spectrum entropies are pulled in through outer joins so that
+    # everything comes back in a single query
+    internal_ids = db.select(Contents.internal_id).filter(Contents.dtxsid == dtxsid)
     record_query = db.select(
         RecordInfo.source, RecordInfo.internal_id, RecordInfo.link, RecordInfo.record_type, RecordInfo.methodologies,
-        RecordInfo.data_type, RecordInfo.description, func.count(Contents.dtxsid)
+        RecordInfo.data_type, RecordInfo.description, func.count(Contents.dtxsid),
+        Methods.internal_id.label("method_internal_id"), Methods.method_number, Methods.document_type,
+        MassSpectra.internal_id.label("spectrum_internal_id"), MassSpectra.spectral_entropy,
+        MassSpectra.normalized_entropy
     ).join_from(
         RecordInfo, Contents, Contents.internal_id == RecordInfo.internal_id
+    ).join_from(
+        RecordInfo, Methods, Methods.internal_id == RecordInfo.internal_id, isouter=True
+    ).join_from(
+        RecordInfo, MassSpectra, MassSpectra.internal_id == RecordInfo.internal_id, isouter=True
     ).filter(
-        RecordInfo.internal_id.in_(internal_ids)
+        RecordInfo.internal_id.in_(internal_ids.scalar_subquery())
     ).group_by(
-        RecordInfo.internal_id
+        RecordInfo.internal_id, Methods.internal_id, MassSpectra.internal_id
     )
-    records = [r._asdict() for r in db.session.execute(record_query)]
-
-    # add method numbers to methods found in the search
-    method_number_query = db.select(Methods.internal_id, Methods.method_number, Methods.document_type).filter(
-        Methods.internal_id.in_(internal_ids))
-    method_info = [r._asdict() for r in db.session.execute(method_number_query)]
-    method_info = {mn["internal_id"]: {"method_number": mn["method_number"], "document_type": mn["document_type"]} for
-                   mn in method_info}
-
-    # add mass spectrum entropies to data
-    spectrum_data_query = db.select(MassSpectra.internal_id, MassSpectra.spectral_entropy,
-                                    MassSpectra.normalized_entropy).filter(MassSpectra.internal_id.in_(internal_ids))
-    spectrum_info = [r._asdict() for r in db.session.execute(spectrum_data_query)]
-    spectrum_info = {
-        si["internal_id"]: {"spectral_entropy": si["spectral_entropy"], "normalized_entropy": si["normalized_entropy"]}
-        for si in spectrum_info}
-
-    for r in records:
-        if r["internal_id"] in method_info:
-            r["method_number"] = method_info[r["internal_id"]]["method_number"]
-            r["method_type"] = method_info[r["internal_id"]]["document_type"]
+
+    # missing record types are reported with counts of zero
+    records = []
+    record_type_counts = Counter({"Method": 0, "Fact Sheet": 0, "Spectrum": 0})
+    for row in db.session.execute(record_query).mappings():
+        r = {k: row[k] for k in ["source", "internal_id", "link", "record_type", "methodologies", "data_type",
+                                 "description", "count"]}
+        if row["method_internal_id"] is not None:
+            r["method_number"] = row["method_number"]
+            r["method_type"] = row["document_type"]
         if r["record_type"] == "Spectrum":
-            if r["internal_id"] in spectrum_info:
-                r["spectrum_rating"] = spectrum.spectrum_rating(
-                    spectrum_info[r["internal_id"]]["spectral_entropy"],
-                    spectrum_info[r["internal_id"]]["normalized_entropy"]
-                )
+            if row["spectrum_internal_id"] is not None:
+                r["spectrum_rating"] = spectrum.spectrum_rating(row["spectral_entropy"], row["normalized_entropy"])
             else:
                 r["spectrum_rating"] = "N/A"
-
-    # Fill in missing record types with zeroes
-    result_record_types = [r["record_type"] for r in records]
-    record_type_counts = Counter(result_record_types)
-    for record_type in ["Method", "Fact Sheet", "Spectrum"]:
-        if record_type not in record_type_counts:
-            record_type_counts[record_type] = 0
+        records.append(r)
+        record_type_counts[r["record_type"]] += 1
     record_type_counts = {k.lower(): v for k, v in record_type_counts.items()}
 
     return jsonify({"records": records, "record_type_counts": record_type_counts})
@@ -299,25 +459,16 @@ def retrieve_mass_spectrum(internal_id):
       204:
         description: A message saying that no spectrum with the given ID was found.
     """
-    q = db.select(
-        MassSpectra.spectrum, MassSpectra.splash, MassSpectra.normalized_entropy, MassSpectra.spectral_entropy,
-        MassSpectra.has_associated_method, MassSpectra.spectrum_metadata
-    ).filter(MassSpectra.internal_id == internal_id)
-    data_row = db.session.execute(q).first()
+    # Postgres stores the missing values for entropies as 'NaN', which the JSON provider sends as null
+    data_row = db.session.execute(MASS_SPECTRUM_QUERY, {"internal_id": internal_id}).mappings().first()
     if data_row is not None:
-        data_dict = data_row._asdict()
-
-        # Postgres stores the missing values for entropies as 'NaN'; for some reason, passing these
-        # to jsonify() causes it to send the dictionary as a string, so fix that
-        if len(data_dict["spectrum"]) == 1:
-            data_dict["spectral_entropy"] = None
-            data_dict["normalized_entropy"] = None
-        return jsonify(data_dict)
+        return jsonify(dict(data_row))
     else:
         return Response(f"No mass spectrum with ID '{internal_id}' exists.", status=204)
 
 
 @app.get("/api/amos/fact_sheet_list")
+@cached_response
 def fact_sheet_list():
     """
     Retrieves a list of fact sheets in the database with their supplemental information.
@@ -336,21 +487,22 @@ def fact_sheet_list():
         RecordInfo, Contents, RecordInfo.internal_id == Contents.internal_id, isouter=True
     ).group_by(
         FactSheets.internal_id, RecordInfo.internal_id
-    )
-    results = [r._asdict() for r in db.session.execute(q).all()]
+    ).execution_options(stream_results=True)
+    results = [dict(r) for r in db.session.execute(q).yield_per(500).mappings()]
 
     single_dtxsid_ids = [r["internal_id"] for r in results if r["count"] == 1]
-    q2 = db.select(Contents.internal_id, Contents.dtxsid).filter(Contents.internal_id.in_(single_dtxsid_ids))
+    q2 = db.select(Contents.internal_id, Contents.dtxsid).filter(cq.any_of(Contents.internal_id, single_dtxsid_ids))
     single_dtxsid_results = {r.internal_id: r.dtxsid for r in db.session.execute(q2).all()}
 
     for i in range(len(results)):
         if results[i]["internal_id"] in single_dtxsid_results:
             results[i]["dtxsid"] = single_dtxsid_results[results[i]["internal_id"]]
 
-    return jsonify({"results": results})
+    return {"results": results}
 
 
 @app.get("/api/amos/method_list")
+@cached_response
 def method_list():
     """
     Retrieves a list of methods in the database with their supplemental information.
@@ -374,9 +526,11 @@ def method_list():
         Methods.internal_id, RecordInfo.internal_id
     )
 
-    results = [r._asdict() for r in db.session.execute(q).all()]
-    results = [{**r, "year_published": util.clean_year(r["date_published"])} for r in results]
-    for r in results:
+    # rows are streamed and finished off one at a time rather than fetched all at once
+    q = q.execution_options(stream_results=True)
+    results = []
+    for r in db.session.execute(q).yield_per(500).mappings():
+        r = {**r, "year_published": util.clean_year(r["date_published"])}
         if pm := r.get("pdf_metadata"):
             r["author"] = pm.get("Author", None)
             r["limitation"] = pm.get("Limitation", None)
@@ -385,6 +539,7 @@ def method_list():
             del r["pdf_metadata"]
         else:
             r["author"] = None
+        results.append(r)
 
     return {"results": results}
 
@@ -416,13 +571,14 @@ def get_pdf(record_type, internal_id):
         description: An invalid record type was supplied.
     """
 
-    if record_type.lower() not in ["fact sheet", "method", "spectrum"]:
+    if record_type.lower() not in cq.PDF_TABLES:
         return Response(f"Invalid record type '{record_type}'; accepted values are 'fact sheet', 'method', and 'spectrum'.", status=404)
 
-    pdf_content = cq.pdf_by_id(internal_id, record_type.lower())
-    if pdf_content:
-        response = make_response(pdf_content)
-        response.headers['Content-Type'] = "application/pdf"
+    pdf_size = cq.pdf_size(internal_id, record_type.lower())
+    if pdf_size:
+        pdf_chunks = cq.pdf_chunks(internal_id, record_type.lower(), pdf_size)
+        response = Response(stream_with_context(pdf_chunks), mimetype="application/pdf")
+        response.headers['Content-Length'] = pdf_size
         response.headers['Content-Disposition'] = f"inline; filename=\"{internal_id}.pdf\""
         return response
     else:
@@ -458,7 +614,7 @@ def get_pdf_metadata(record_type, internal_id):
         description: No record of the specified type was found for the specified ID.
     """
 
-    if record_type.lower() not in ["fact sheet", "method", "spectrum"]:
+    if record_type.lower() not in cq.PDF_TABLES:
         return Response(f"Invalid record type '{record_type}'; accepted values are 'fact sheet', 'method', and 'spectrum'.", status=404)
 
     metadata = cq.pdf_metadata(internal_id, record_type.lower())
@@ -469,6 +625,7 @@ def get_pdf_metadata(record_type, internal_id):
 
 
 @app.get("/api/amos/find_dtxsids/<internal_id>")
+@util.ttl_cache(max_entries=util.RECORD_CACHE_SIZE)
 def find_dtxsids(internal_id):
     """
     Returns a list of DTXSIDs associated with the specified internal ID, along with additional substance information.
@@ -488,7 +645,7 @@ def find_dtxsids(internal_id):
     substance_list = cq.substances_for_ids(internal_id)
     if len(substance_list) == 0:
         print(f"Warning -- no DTXSIDs found for internal ID {internal_id}")
-    return jsonify({"substance_list": substance_list})
+    return {"substance_list": substance_list}
 
 
 @app.get("/api/amos/substance_similarity_search/<dtxsid>")
@@ -510,19 +667,33 @@ def find_similar_substances(dtxsid, similarity_threshold=0.8):
         description: A list of similar substances, or None if none were found.
     """
 
+    return {"similar_substance_info": similar_substances_from_api(dtxsid, similarity_threshold)}
+
+
+@util.ttl_cache(seconds=SIMILAR_SUBSTANCE_CACHE_TTL, cache_none=False)
+def similar_substances_from_api(dtxsid, similarity_threshold):
+    """
+    Calls the CCTE API for substances similar to the given DTXSID.  Responses
+    are cached, since they only change when the CCTE data does; failed or
+    timed-out calls return None and aren't cached.
+    """
     BASE_URL = f"{ccte_api_server}/similar-compound/by-dtxsid/"
 
     # workaround for [SSL: UNSAFE_LEGACY_RENEGOTIATION_DISABLED]
     # https://stackoverflow.com/questions/71603314/ssl-error-unsafe-legacy-renegotiation-disabled
     url = f"{BASE_URL}{dtxsid}/{similarity_threshold}"
     logging.info(f"Calling {url}")
-    response = get_legacy_session().get(url)
+    try:
+        response = legacy_session.get(url, timeout=CCTE_API_TIMEOUT)
+    except requests.RequestException as e:
+        print("Error: ", e)
+        return None
 
     if response.status_code == 200:
-        return {"similar_substance_info": response.json()}
+        return response.json()
     else:
         print("Error: ", response.status_code)
-        return {"similar_substance_info": None}
+        return None
 
 
 @app.get("/api/amos/get_similar_structures/<dtxsid>")
@@ -557,45 +728,58 @@ def get_similar_structures(dtxsid):
 
     methods_query = db.select(
         Contents.internal_id, Contents.dtxsid, RecordInfo.source, RecordInfo.methodologies,
-        Methods.method_name, Methods.date_published
+        func.array_to_string(RecordInfo.methodologies, ", ").label("methodology"),
+        Methods.method_name, Methods.date_published, Substances.dtxsid.label("substance_dtxsid"),
+        Substances.preferred_name.label("substance_name")
     ).filter(
-        Contents.dtxsid.in_(similar_dtxsids)
+        cq.any_of(Contents.dtxsid, similar_dtxsids)
     ).join_from(
         Contents, RecordInfo, Contents.internal_id == RecordInfo.internal_id
     ).join_from(
         Contents, Methods, Contents.internal_id == Methods.internal_id
+    ).join_from(
+        Contents, Substances, Contents.dtxsid == Substances.dtxsid, isouter=True
     )
     method_results = [c._asdict() for c in db.session.execute(methods_query).all()]
 
     fact_sheet_query = db.select(
-        Contents.internal_id, Contents.dtxsid, RecordInfo.source, FactSheets.fact_sheet_name
+        Contents.internal_id, Contents.dtxsid, RecordInfo.source, FactSheets.fact_sheet_name,
+        Substances.dtxsid.label("substance_dtxsid"), Substances.preferred_name.label("substance_name")
     ).filter(
-        Contents.dtxsid.in_(similar_dtxsids)
+        cq.any_of(Contents.dtxsid, similar_dtxsids)
     ).join_from(
         Contents, RecordInfo, Contents.internal_id == RecordInfo.internal_id
     ).join_from(
         Contents, FactSheets, Contents.internal_id == FactSheets.internal_id
+    ).join_from(
+        Contents, Substances, Contents.dtxsid == Substances.dtxsid, isouter=True
     )
     fact_sheet_results = [c._asdict() for c in db.session.execute(fact_sheet_query).all()]
 
-    methods_with_searched_substance = [r["internal_id"] for r in method_results if r["dtxsid"] == dtxsid]
-    fact_sheets_with_searched_substance = [r["internal_id"] for r in fact_sheet_results if r["dtxsid"] == dtxsid]
-    dtxsid_names = cq.names_for_dtxsids([r["dtxsid"] for r in method_results + fact_sheet_results])
+    methods_with_searched_substance = {r["internal_id"] for r in method_results if r["dtxsid"] == dtxsid}
+    fact_sheets_with_searched_substance = {r["internal_id"] for r in fact_sheet_results if r["dtxsid"] == dtxsid}
+
+    # substance names come back with the records; collect them for the per-substance counts
+    dtxsid_names = {}
+    for r in method_results + fact_sheet_results:
+        if r.pop("substance_dtxsid") is not None:
+            dtxsid_names[r["dtxsid"]] = r["substance_name"]
 
     # merge info, supply a boolean for whether the searched substance is in the
     # method, and parse the publication year
-    method_results = [{
-        **r, "similarity": similarity_dict[r["dtxsid"]], "substance_name": dtxsid_names.get(r["dtxsid"]),
-        "has_searched_substance": r["internal_id"] in methods_with_searched_substance,
-        "year_published": util.clean_year(r["date_published"]),
-        "methodology": ", ".join(r["methodologies"]) if r["methodologies"] is not None else None
-    } for r in method_results]
+    for r in method_results:
+        r.update({
+            "similarity": similarity_dict[r["dtxsid"]],
+            "has_searched_substance": r["internal_id"] in methods_with_searched_substance,
+            "year_published": util.clean_year(r["date_published"])
+        })
     ids_to_method_names = {r["internal_id"]: r["method_name"] for r in method_results}
 
-    fact_sheet_results = [{
-        **r, "similarity": similarity_dict[r["dtxsid"]], "substance_name": dtxsid_names.get(r["dtxsid"]),
-        "has_searched_substance": r["internal_id"] in fact_sheets_with_searched_substance
-    } for r in fact_sheet_results]
+    for r in fact_sheet_results:
+        r.update({
+            "similarity": similarity_dict[r["dtxsid"]],
+            "has_searched_substance": r["internal_id"] in fact_sheets_with_searched_substance
+        })
     ids_to_fact_sheet_names = {r["internal_id"]: r["fact_sheet_name"] for r in fact_sheet_results}
 
     method_dtxsid_counts = Counter([r["dtxsid"] for r in method_results])
@@ -701,15 +885,17 @@ def batch_search():
     #### PART 1: Fire off the initial queries to the database for record counts. ####
 
     substance_query = db.select(Substances.dtxsid, Substances.casrn, Substances.preferred_name).filter(
-        Substances.dtxsid.in_(dtxsid_list))
+        cq.any_of(Substances.dtxsid, dtxsid_list))
     substance_df = pd.DataFrame([c._asdict() for c in db.session.execute(substance_query).all()])
 
+    # methodologies are rendered as a delimited string by the database rather than printing the list object
     record_query = db.select(
-        Contents.internal_id, Contents.dtxsid, RecordInfo.methodologies, RecordInfo.source, RecordInfo.link,
-        RecordInfo.record_type, RecordInfo.description, RecordInfo.data_type
+        Contents.internal_id, Contents.dtxsid,
+        func.array_to_string(RecordInfo.methodologies, "; ").label("methodologies"), RecordInfo.source,
+        RecordInfo.link, RecordInfo.record_type, RecordInfo.description, RecordInfo.data_type
     ).join_from(
         Contents, RecordInfo, Contents.internal_id == RecordInfo.internal_id
-    ).filter(Contents.dtxsid.in_(dtxsid_list))
+    ).filter(cq.any_of(Contents.dtxsid, dtxsid_list))
 
     if not methodologies["all"]:
         accepted_methodologies = [k for k, v in methodologies.items() if (k != "all") and v]
@@ -718,23 +904,20 @@ def batch_search():
 
     accepted_record_types = [k for k, v in record_types.items() if (k != "all") and v]
     record_query = record_query.filter(RecordInfo.record_type.in_(accepted_record_types))
-    records = [c._asdict() for c in db.session.execute(record_query).all()]
-
     if not include_external_links:
-        # don't add this as a filter to the query; it'll miss records without sources if it's added there
-        records = [r for r in records if r["data_type"] is not None]
-    for i, r in enumerate(records):
+        # external links are the records without a data type stored in the database
+        record_query = record_query.filter(RecordInfo.data_type.isnot(None))
+    records = []
+    for r in db.session.execute(record_query).mappings():
+        r = dict(r)
         if href := util.construct_internal_href(r['internal_id'], r['record_type'], r['data_type']):
-            records[i]["AMOS Link"] = base_url + href
+            r["AMOS Link"] = base_url + href
+        records.append(r)
 
     #### PART 2: Construct the dataframe for the record info, if there are records to get info for. ####
 
     if len(records) == 0:
         if always_download_file:
-            record_df = pd.DataFrame([], columns=[
-                "dtxsid", "casrn", "preferred_name", "internal_id", "methodologies", "source",
-                "record_type", "AMOS Link", "link", "count", "description"
-            ])
             result_df = pd.DataFrame([], columns=[
                 "DTXSID", "CASRN", "Substance Name", "AMOS Record ID", "Methodologies", "Source",
                 "Record Type", "AMOS Link", "Source Link", "# Substances in Record", "Description"
@@ -751,11 +934,6 @@ def batch_search():
         substances_per_record_df = pd.DataFrame(substances_per_record)
         record_df = record_df.merge(substances_per_record_df, how="left", on="internal_id")
 
-        # render methodologies as a delimited string rather than printing the list object
-        has_methodology = ~record_df["methodologies"].isna()
-        record_df.loc[has_methodology, "methodologies"] = record_df.loc[has_methodology, "methodologies"].apply(
-            lambda x: "; ".join(x))
-
         result_df = substance_df.merge(record_df, how="right", on="dtxsid")
         result_df = result_df[[
             "dtxsid", "casrn", "preferred_name", "internal_id", "methodologies", "source", "record_type",
@@ -769,7 +947,7 @@ def batch_search():
                 MassSpectra.internal_id, MassSpectra.spectral_entropy, MassSpectra.normalized_entropy,
                 MassSpectra.spectrum_metadata,
                 func.array_length(MassSpectra.spectrum, 1).label("num_peaks")
-            ).filter(MassSpectra.internal_id.in_(found_record_ids))
+            ).filter(cq.any_of(MassSpectra.internal_id, found_record_ids))
             ms_info = pd.DataFrame([c._asdict() for c in db.session.execute(ms_info_query).all()])
             ms_info["rating"] = ms_info.apply(
                 lambda x: spectrum.spectrum_rating(x.spectral_entropy, x.normalized_entropy), axis=1)
@@ -792,17 +970,16 @@ def batch_search():
             "count": "# Substances in Record"
         }, axis=1, inplace=True)
 
-    result_counts = record_df.groupby(["dtxsid"]).size().reset_index()
-    result_counts.columns = ["dtxsid", "num_records"]
-    result_counts = pd.DataFrame({"dtxsid": dtxsid_list}).merge(substance_df, how="left", on="dtxsid").merge(
-        result_counts, how="left", on="dtxsid")
-    result_counts["num_records"] = result_counts["num_records"].fillna(0)
+    # the record rows are already in hand for the records sheet, so count them directly
+    records_per_dtxsid = Counter(r["dtxsid"] for r in records)
+    result_counts = pd.DataFrame({"dtxsid": dtxsid_list}).merge(substance_df, how="left", on="dtxsid")
+    result_counts["num_records"] = [records_per_dtxsid[d] for d in result_counts["dtxsid"]]
 
     # add more substance info, if appropriate
     if include_classyfire:
         classyfire_query = db.select(
             ClassyFire.dtxsid, ClassyFire.kingdom, ClassyFire.superklass, ClassyFire.klass, ClassyFire.subklass
-        ).filter(ClassyFire.dtxsid.in_(dtxsid_list))
+        ).filter(cq.any_of(ClassyFire.dtxsid, dtxsid_list))
         classyfire_results = [c._asdict() for c in db.session.execute(classyfire_query).all()]
         classyfire_df = pd.DataFrame(classyfire_results)
         result_counts = result_counts.merge(classyfire_df, how="left", on="dtxsid")
@@ -884,7 +1061,7 @@ def analytical_qc_batch_search():
     include_functional_uses = parameters["include_functional_uses"]
 
     substance_query = db.select(Substances.dtxsid, Substances.casrn, Substances.preferred_name).filter(
-        Substances.dtxsid.in_(dtxsid_list))
+        cq.any_of(Substances.dtxsid, dtxsid_list))
     substances = [c._asdict() for c in db.session.execute(substance_query).all()]
     substance_df = pd.DataFrame(substances)
 
@@ -892,7 +1069,7 @@ def analytical_qc_batch_search():
         Contents.internal_id, Contents.dtxsid, RecordInfo.methodologies, RecordInfo.link, RecordInfo.description
     ).join_from(
         Contents, RecordInfo, Contents.internal_id == RecordInfo.internal_id
-    ).filter(Contents.dtxsid.in_(dtxsid_list) & (RecordInfo.source == "Analytical QC"))
+    ).filter(cq.any_of(Contents.dtxsid, dtxsid_list) & (RecordInfo.source == "Analytical QC"))
 
     if not methodologies["all"]:
         accepted_methodologies = [k for k, v in methodologies.items() if (k != "all") and v]
@@ -909,17 +1086,16 @@ def analytical_qc_batch_search():
 
     result_df = substance_df.merge(record_df, how="right", on="dtxsid")
 
-    result_counts = record_df.groupby(["dtxsid"]).size().reset_index()
-    result_counts.columns = ["dtxsid", "num_records"]
-    result_counts = pd.DataFrame({"dtxsid": dtxsid_list}).merge(substance_df, how="left", on="dtxsid").merge(
-        result_counts, how="left", on="dtxsid")
-    result_counts["num_records"] = result_counts["num_records"].fillna(0)
+    # the record rows are already in hand for the records sheet, so count them directly
+    records_per_dtxsid = Counter(r["dtxsid"] for r in records)
+    result_counts = pd.DataFrame({"dtxsid": dtxsid_list}).merge(substance_df, how="left", on="dtxsid")
+    result_counts["num_records"] = [records_per_dtxsid[d] for d in result_counts["dtxsid"]]
 
     # add more substance info, if appropriate
     if include_classyfire:
         classyfire_query = db.select(
             ClassyFire.dtxsid, ClassyFire.kingdom, ClassyFire.superklass, ClassyFire.klass, ClassyFire.subklass
-        ).filter(ClassyFire.dtxsid.in_(dtxsid_list))
+        ).filter(cq.any_of(ClassyFire.dtxsid, dtxsid_list))
         classyfire_results = [c._asdict() for c in db.session.execute(classyfire_query).all()]
         classyfire_df = pd.DataFrame(classyfire_results)
         result_counts = result_counts.merge(classyfire_df, how="left", on="dtxsid")
@@ -943,7 +1119,7 @@ def analytical_qc_batch_search():
         AnalyticalQC.internal_id, AnalyticalQC.first_timepoint, AnalyticalQC.last_timepoint,
         AnalyticalQC.stability_call, AnalyticalQC.timepoint
     ).join_from(AnalyticalQC, Contents, AnalyticalQC.internal_id == Contents.internal_id).filter(
-        Contents.dtxsid.in_(dtxsid_list))
+        cq.any_of(Contents.dtxsid, dtxsid_list))
     analytical_qc_results = [c._asdict() for c in db.session.execute(analytical_qc_query).all()]
     analytical_qc_df = pd.DataFrame(analytical_qc_results)
     result_df = result_df.merge(analytical_qc_df, how="left", on="internal_id")
@@ -1009,7 +1185,7 @@ def method_with_spectra_search(search_type, internal_id):
     info_q = db.select(
         Contents.internal_id, Contents.dtxsid, Substances.preferred_name
     ).filter(
-        Contents.internal_id.in_(spectrum_list)
+        cq.any_of(Contents.internal_id, spectrum_list)
     ).join_from(
         Contents, Substances, Contents.dtxsid == Substances.dtxsid
     )
@@ -1048,14 +1224,15 @@ def get_spectrum_count_for_methodology():
         description: A count of spectra in the database for the given substance and analytical methodology.
     """
 
-    dtxsid = request.get_json()["dtxsid"]
-    spectrum_type = request.get_json()["spectrum_type"]
+    request_json = request.get_json()
+    dtxsid = request_json["dtxsid"]
+    spectrum_type = request_json["spectrum_type"]
 
-    q = db.select(Contents.internal_id).filter(
+    q = db.select(func.count()).filter(
         RecordInfo.methodologies.contains([spectrum_type]) & (RecordInfo.record_type == "Spectrum") & (
                 Contents.dtxsid == dtxsid)
     ).join_from(Contents, RecordInfo, Contents.internal_id == RecordInfo.internal_id)
-    return jsonify({"count": len(db.session.execute(q).all())})
+    return jsonify({"count": db.session.execute(q).scalar()})
 
 
 @app.post("/api/amos/substances_for_ids/")
@@ -1083,9 +1260,9 @@ def get_substances_for_ids():
     internal_id_list = request.get_json()["internal_id_list"]
 
     substances = cq.substances_for_ids(internal_id_list, [Substances.jchem_inchikey])
-    substance_df = pd.DataFrame(substances)
+    columns = ["dtxsid", "preferred_name", "casrn", "image_in_comptox", "jchem_inchikey"]
 
-    excel_file = util.make_excel_file({"Substances": substance_df})
+    excel_file = util.make_excel_file({"Substances": (columns, [[s[c] for c in columns] for s in substances])})
     headers = {"Content-Disposition": "attachment; filename=Substances.xlsx",
                "Content-type": "application/vnd.ms-excel"}
     return Response(excel_file, mimetype="application/vnd.ms-excel", headers=headers)
@@ -1113,7 +1290,7 @@ def count_substances_in_ids():
         description: A JSON object with the count of unique substances between all submitted records.
     """
     internal_id_list = request.get_json()["internal_id_list"]
-    q = db.select(func.count(Contents.dtxsid.distinct())).filter(Contents.internal_id.in_(internal_id_list))
+    q = db.select(func.count(Contents.dtxsid.distinct())).filter(cq.any_of(Contents.internal_id, internal_id_list))
     dtxsid_count = db.session.execute(q).first()._asdict()
     return jsonify(dtxsid_count)
 
@@ -1162,24 +1339,36 @@ def mass_spectrum_similarity_search():
     request_json = request.get_json()
     lower_mass_limit = request_json["lower_mass_limit"]
     upper_mass_limit = request_json["upper_mass_limit"]
-    methodology = request.json["methodology"]
-    user_spectrum = request.json["spectrum"]
+    methodology = request_json["methodology"]
+    user_spectrum = request_json["spectrum"]
+    try:
+        spectrum.validate_spectrum(user_spectrum)
+    except ValueError as ve:
+        return jsonify({"error": f"User-supplied spectrum is invalid: {ve}"})
 
     results = cq.mass_spectrum_search(lower_mass_limit, upper_mass_limit, methodology)
 
+    if request_json["type"].lower() == "da":
+        da, ppm = request_json["window"], None
+    else:
+        da, ppm = None, request_json["window"]
+    user_preprocessed = spectrum.preprocess_spectrum(user_spectrum, da_error=da, ppm_error=ppm)
+
+    score = partial(spectrum.entropy_similarities, user_preprocessed=[user_preprocessed], da_error=da, ppm_error=ppm)
+
+    # since the frontend will only ever show stuff with a similarity of at least 0.1, only those
+    # rows are kept as the streamed spectra are scored
+    similar_results = []
     substance_mapping = {}
-    for r in results:
-        if request_json["type"].lower() == "da":
-            r["similarity"] = spectrum.calculate_entropy_similarity(r["spectrum"], user_spectrum,
-                                                                    da_error=request_json["window"])
-        else:
-            r["similarity"] = spectrum.calculate_entropy_similarity(r["spectrum"], user_spectrum,
-                                                                    ppm_error=request_json["window"])
-        if r["similarity"] >= 0.1:
-            substance_mapping[r["dtxsid"]] = r["preferred_name"]
-        del r["preferred_name"]
-    # since the frontend will only ever show stuff with a similarity of at least 0.1, filter the list
-    results = [r for r in results if r["similarity"] >= 0.1]
+    while batch := list(islice(results, SIMILARITY_BATCH_SIZE)):
+        batch_similarities = map_similarity_scoring(score, [r["spectrum"] for r in batch])
+        for r, (similarity,) in zip(batch, batch_similarities):
+            if similarity >= 0.1:
+                r = dict(r)
+                r["similarity"] = similarity
+                substance_mapping[r["dtxsid"]] = r.pop("preferred_name")
+                similar_results.append(r)
+    results = similar_results
     return jsonify({"result_length": len(results), "unique_substances": len(substance_mapping), "results": results,
                     "substance_mapping": substance_mapping})
 
@@ -1246,6 +1435,11 @@ def entropy_similarity():
         description: The entropy similarity of the two spectra.
     """
     post_data = request.get_json()
+    for spectrum_key in ["spectrum_1", "spectrum_2"]:
+        try:
+            spectrum.validate_spectrum(post_data[spectrum_key])
+        except ValueError as ve:
+            return jsonify({"error": f"User-supplied {spectrum_key} is invalid: {ve}"})
     if post_data.get("type") is None:
         similarity = spectrum.calculate_entropy_similarity(post_data["spectrum_1"], post_data["spectrum_2"])
     elif post_data["type"].lower() == "da":
@@ -1341,15 +1535,21 @@ def max_similarity_by_dtxsid():
     if type(ms_level) != int:
         ms_level = None
 
-    # get the list of spectra in the database for the given substances
+    # get the list of spectra in the database for the given substances; these are streamed, so
+    # compare each database spectrum against all of the user spectra in a single pass
     results = cq.mass_spectra_for_substances(dtxsids, ms_level=ms_level)
-    substance_dict = {d: [None] * len(user_spectra) for d in dtxsids}
-    for i, us in enumerate(user_spectra):
-        for r in results:
-            similarity = spectrum.calculate_entropy_similarity(us, r["spectrum"], da_error=da, ppm_error=ppm)
-            if substance_dict[r["dtxsid"]][i] is None or substance_dict[r["dtxsid"]][i] < similarity:
-                substance_dict[r["dtxsid"]][i] = similarity
-
+    user_preprocessed = [spectrum.preprocess_spectrum(us, da_error=da, ppm_error=ppm) for us in user_spectra]
+    # best scores start at -inf so they can be updated with a plain max(); any that are never
+    # updated had no spectra to compare against and are sent back as None
+    substance_dict = {d: [float("-inf")] * len(user_spectra) for d in dtxsids}
+    score = partial(spectrum.entropy_similarities, user_preprocessed=user_preprocessed, da_error=da, ppm_error=ppm)
+    while batch := list(islice(results, SIMILARITY_BATCH_SIZE)):
+        batch_similarities = map_similarity_scoring(score, [r["spectrum"] for r in batch])
+        for r, similarities in zip(batch, batch_similarities):
+            best_similarities = substance_dict[r["dtxsid"]]
+            best_similarities[:] = map(max, best_similarities, similarities)
+
+    substance_dict = {d: [None if s == float("-inf") else s for s in v] for d, v in substance_dict.items()}
     return jsonify({"results": substance_dict})
 
 
@@ -1394,6 +1594,14 @@ def all_similarities_by_dtxsid():
                 type: number
                 description: Minimum intensity level for peaks in both the user and database spectra to consider.  All database spectra are scaled to have a maximum intensity of 100, and all user spectra are assumed to be scaled the same.
                 example: 0
+              mass:
+                type: number
+                description: Neutral monoisotopic mass of the feature the user spectra come from.  If supplied along with mass_tolerance, only substances whose monoisotopic masses are within the tolerance are scored; the rest are returned with no spectra.
+                example: 194.0804
+              mass_tolerance:
+                type: number
+                description: Mass tolerance in daltons for the mass filter.  Only used if mass is also supplied.
+                example: 0.01
     responses:
       200:
         description: An array of JSON objects, where each element in the array corresponds to a user spectrum.  Each JSON objects has DTXSIDs as keys and a list of dictionaries containing similarity information and spectrum metadata, with one entry per database spectrum, as the values.
@@ -1415,47 +1623,44 @@ def all_similarities_by_dtxsid():
     ms_level = request_json.get("ms_level")
     if type(ms_level) != int:
         ms_level = None
+    mass = request_json.get("mass")
+    mass_tolerance = request_json.get("mass_tolerance")
+    if (type(mass) in (int, float)) and (type(mass_tolerance) in (int, float)):
+        mass_range = (mass - mass_tolerance, mass + mass_tolerance)
+    else:
+        mass_range = None
+
+    results = cq.mass_spectra_for_substances(
+        dtxsids, ms_level=ms_level, include_mass=True, mass_range=mass_range,
+        additional_fields=[MassSpectra.spectrum_metadata, cq.SHORT_SPECTRUM_DESCRIPTION]
+    )
 
-    results = cq.mass_spectra_for_substances(dtxsids, ms_level=ms_level,
-                                             additional_fields=[MassSpectra.spectrum_metadata])
-
-    # mass query
-    q = db.select(Substances.dtxsid, Substances.monoisotopic_mass).filter(Substances.dtxsid.in_(dtxsids))
-    mass_results = [c._asdict() for c in db.session.execute(q).all()]
-    mass_dict = {mr["dtxsid"]: mr["monoisotopic_mass"] for mr in mass_results}
-
-    similarity_list = []
-    for us in user_spectra:
-        us = [[mz, i] for mz, i in us if i > min_intensity]
-        substance_dict = {d: [] for d in dtxsids}
-        for r in results:
-            # filter out peaks above the monoisotopic mass (minus a proton or so) and peaks below a certain intensity
-            result_spectrum = [[mz, i] for mz, i in r["spectrum"] if
-                               (mz < (mass_dict[r["dtxsid"]] - 1.5)) and (i > min_intensity)]
-            if len(result_spectrum) == 0:
+    user_spectra = [[[mz, i] for mz, i in us if i > min_intensity] for us in user_spectra]
+    user_preprocessed = [spectrum.preprocess_spectrum(us, da_error=da, ppm_error=ppm) for us in user_spectra]
+    similarity_list = [{d: [] for d in dtxsids} for _ in user_spectra]
+    score = partial(spectrum.score_library_spectrum, user_spectra=user_spectra, user_preprocessed=user_preprocessed,
+                    min_intensity=min_intensity, da_error=da, ppm_error=ppm)
+
+    # the database spectra are streamed, so score them a batch at a time -- this lets the work be
+    # spread across the worker processes without holding every row in memory
+    while batch := list(islice(results, SIMILARITY_BATCH_SIZE)):
+        batch_scores = map_similarity_scoring(score, [r["spectrum"] for r in batch],
+                                              [r["monoisotopic_mass"] for r in batch])
+        for r, result_scores in zip(batch, batch_scores):
+            if result_scores is None:
                 continue
-            if r["description"].startswith("#"):
-                description = None
-            else:
-                description = ";".join(r["description"].split(";")[:-1])
-            combined_spectrum = spectrum.combine_peaks(result_spectrum)
-            spectral_entropy = spectrum.calculate_spectral_entropy(combined_spectrum)
-            normalized_entropy = spectral_entropy / len(combined_spectrum)
-            information = {"Points": len(result_spectrum), "Spectral Entropy": spectral_entropy,
-                           "Normalized Entropy": normalized_entropy,
-                           "Rating": spectrum.spectrum_rating(spectral_entropy, normalized_entropy)}
-            entropy_similarity = spectrum.calculate_entropy_similarity(us, combined_spectrum, da_error=da,
-                                                                       ppm_error=ppm)
-            cosine_similarity = spectrum.cosine_similarity(us, combined_spectrum)
-            substance_dict[r["dtxsid"]].append(
-                {"entropy_similarity": entropy_similarity, "cosine_similarity": cosine_similarity,
-                 "description": description, "metadata": r["spectrum_metadata"], "information": information})
-        similarity_list.append(substance_dict)
+            information, similarities = result_scores
+            for (entropy_similarity, cosine_similarity), substance_dict in zip(similarities, similarity_list):
+                substance_dict[r["dtxsid"]].append(
+                    {"entropy_similarity": entropy_similarity, "cosine_similarity": cosine_similarity,
+                     "description": r["short_description"], "metadata": r["spectrum_metadata"],
+                     "information": information})
 
     return jsonify({"results": similarity_list})
 
 
 @app.get("/api/amos/get_info_by_id/<internal_id>")
+@util.ttl_cache(max_entries=util.RECORD_CACHE_SIZE)
 def get_info_by_id(internal_id):
     """
     Returns general information about a record by ID.
@@ -1471,12 +1676,11 @@ def get_info_by_id(internal_id):
       200:
         description: Record information for the specified ID.
     """
-    q = db.select(RecordInfo).filter(RecordInfo.internal_id == internal_id)
-    result = db.session.execute(q).first()
+    result = db.session.execute(INFO_BY_ID_QUERY, {"internal_id": internal_id}).mappings().first()
     if result:
-        return jsonify({"result": result[0].get_row_contents()})
+        return {"result": dict(result)}
     else:
-        return jsonify({"result": None})
+        return {"result": None}
 
 
 @app.get("/api/amos/database_summary/")
@@ -1488,8 +1692,7 @@ def database_summary():
       200:
         description: A summary of the data in the database.
     """
-    summary_info = cq.database_summary()
-    return jsonify(summary_info)
+    return cq.database_summary()
 
 
 @app.post("/api/amos/mass_spectra_for_substances/")
@@ -1518,7 +1721,7 @@ def mass_spectra_for_substances():
         description: A JSON object containing a list of mass spectra and a mapping of DTXSIDs to names for any substances found.
     """
     dtxsids = request.get_json()["dtxsids"]
-    spectrum_results = cq.mass_spectra_for_substances(dtxsids)
+    spectrum_results = [dict(r) for r in cq.mass_spectra_for_substances(dtxsids)]
     names_for_dtxsids = cq.names_for_dtxsids(dtxsids)
     return jsonify({"spectra": spectrum_results, "substance_mapping": names_for_dtxsids})
 
@@ -1543,18 +1746,30 @@ def get_image_for_dtxsid(dtxsid):
       204:
         description: No image matching the DTXSID was found.
     """
-    q = db.select(SubstanceImages.png_image).filter(SubstanceImages.dtxsid == dtxsid)
-    result = db.session.execute(q).first()
-    if result is not None:
-        image = result.png_image
+    image = substance_image(dtxsid)
+    if image is not None:
         response = make_response(image)
         response.headers['Content-Type'] = "image/png"
         response.headers['Content-Disposition'] = f"inline; filename=\"{dtxsid}\".png"
-        return response
+        # images rarely change, so let browsers and proxies keep them and revalidate with the ETag
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_MAX_AGE
+        response.add_etag()
+        return response.make_conditional(request)
     else:
         return Response(status=204)
 
 
+@util.ttl_cache(max_entries=IMAGE_CACHE_SIZE)
+def substance_image(dtxsid):
+    """
+    Returns the PNG image stored in the database for a substance, or None if
+    there isn't one.
+    """
+    result = db.session.execute(SUBSTANCE_IMAGE_QUERY, {"dtxsid": dtxsid}).first()
+    return result.png_image if result is not None else None
+
+
 @app.get("/api/amos/substring_search/<substring>")
 def substring_search(substring):
     """
@@ -1615,28 +1830,25 @@ def get_ms_ready_methods(inchikey):
     first_block = inchikey.split("-")[0]
     q = db.select(
         RecordInfo.source, RecordInfo.internal_id, RecordInfo.link, RecordInfo.record_type, RecordInfo.methodologies,
-        RecordInfo.data_type, RecordInfo.description, func.count(Contents.dtxsid)
+        RecordInfo.data_type, RecordInfo.description, func.count(Contents.dtxsid), Methods.method_number
     ).filter(
         Substances.jchem_inchikey.like(first_block + "%") & (Substances.jchem_inchikey != inchikey)
     ).join_from(
         Contents, Substances, Contents.dtxsid == Substances.dtxsid
     ).join_from(
         Contents, RecordInfo, Contents.internal_id == RecordInfo.internal_id
+    ).join_from(
+        RecordInfo, Methods, RecordInfo.internal_id == Methods.internal_id, isouter=True
     ).group_by(
-        RecordInfo.internal_id
+        RecordInfo.internal_id, Methods.internal_id
     )
     results = [c._asdict() for c in db.session.execute(q).all()]
 
-    internal_ids = [c["internal_id"] for c in results]
-    method_number_query = db.select(Methods.internal_id, Methods.method_number).filter(
-        Methods.internal_id.in_(internal_ids))
-    method_numbers = [r._asdict() for r in db.session.execute(method_number_query)]
-    method_numbers = {mn["internal_id"]: mn["method_number"] for mn in method_numbers}
-
     for r in results:
         r["ms_ready"] = True  # flag for Ag Grid
-        if r["internal_id"] in method_numbers:
-            r["method_number"] = method_numbers[r["internal_id"]]
+        # only methods have method numbers
+        if r["method_number"] is None:
+            del r["method_number"]
 
     return jsonify({"length": len(results), "results": results})
 
@@ -1657,11 +1869,10 @@ def get_substance_file_for_record(internal_id):
       200:
         description: An Excel workbook listing the substances in the specified record.
     """
-    substance_list = find_dtxsids(internal_id).json["substance_list"]
+    substance_list = find_dtxsids(internal_id)["substance_list"]
     substance_list = [(sl["dtxsid"], sl["casrn"], sl["preferred_name"]) for sl in substance_list]
-    substance_df = pd.DataFrame(substance_list, columns=["DTXSID", "CASRN", "Preferred Name"])
 
-    excel_file = util.make_excel_file({"Substances": substance_df})
+    excel_file = util.make_excel_file({"Substances": (["DTXSID", "CASRN", "Preferred Name"], substance_list)})
     headers = {"Content-Disposition": "attachment; filename=substances.xlsx",
                "Content-type": "application/vnd.ms-excel"}
     return Response(excel_file, mimetype="application/vnd.ms-excel", headers=headers)
@@ -1729,12 +1940,7 @@ def retrieve_nmr_spectrum(internal_id):
       204:
         description: No NMR spectrum was found for the given internal ID.
     """
-    q = db.select(
-        NMRSpectra.intensities, NMRSpectra.first_x, NMRSpectra.last_x, NMRSpectra.x_units,
-        NMRSpectra.frequency, NMRSpectra.nucleus, NMRSpectra.temperature, NMRSpectra.solvent,
-        NMRSpectra.spectrum_metadata
-    ).filter(NMRSpectra.internal_id == internal_id)
-    data_row = db.session.execute(q).first()
+    data_row = db.session.execute(NMR_SPECTRUM_QUERY, {"internal_id": internal_id}).first()
     if data_row is not None:
         data_dict = data_row._asdict()
         return jsonify(data_dict)
@@ -2047,11 +2253,7 @@ def get_ir_spectrum(internal_id):
       204:
         description: No IR spectrum was found for the given internal ID.
     """
-    q = db.select(
-        InfraredSpectra.first_x, InfraredSpectra.intensities, InfraredSpectra.ir_type,
-        InfraredSpectra.laser_frequency, InfraredSpectra.last_x, InfraredSpectra.spectrum_metadata
-    ).filter(InfraredSpectra.internal_id == internal_id)
-    data_row = db.session.execute(q).first()
+    data_row = db.session.execute(IR_SPECTRUM_QUERY, {"internal_id": internal_id}).first()
     if data_row is not None:
         data_dict = data_row._asdict()
         return jsonify(data_dict)
@@ -2113,11 +2315,11 @@ def record_type_count(record_type):
     possible_record_types = {"analytical_qc", "fact_sheets", "methods"}
     if record_type in possible_record_types:
         if record_type == "methods":
-            query = db.select(func.count(Methods.internal_id))
+            query = db.select(func.count()).select_from(Methods)
         elif record_type == "analytical_qc":
-            query = db.select(func.count(AnalyticalQC.internal_id))
+            query = db.select(func.count()).select_from(AnalyticalQC)
         else:
-            query = db.select(func.count(FactSheets.internal_id))
+            query = db.select(func.count()).select_from(FactSheets)
         record_count = db.session.execute(query).first()[0]
         return jsonify({"record_count": record_count})
     else:
@@ -2211,7 +2413,7 @@ def fact_sheet_pagination(limit, offset):
     results = [r._asdict() for r in db.session.execute(q).all()]
 
     single_dtxsid_ids = [r["internal_id"] for r in results if r["count"] == 1]
-    q2 = db.select(Contents.internal_id, Contents.dtxsid).filter(Contents.internal_id.in_(single_dtxsid_ids))
+    q2 = db.select(Contents.internal_id, Contents.dtxsid).filter(cq.any_of(Contents.internal_id, single_dtxsid_ids))
     single_dtxsid_results = {r.internal_id: r.dtxsid for r in db.session.execute(q2).all()}
 
     for i in range(len(results)):
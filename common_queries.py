@@ -1,8 +1,10 @@
 from collections import defaultdict
 
 import requests
-from sqlalchemy import func
+from sqlalchemy import any_, bindparam, case, func, literal, null, union_all
+from sqlalchemy.dialects.postgresql import ARRAY
 
+import util
 from table_definitions import db, AdditionalSources, AdditionalSubstanceInfo, \
     AnalyticalQC, ClassyFire, Contents, DatabaseSummary, FactSheets, \
     FunctionalUseClasses, MassSpectra, Methods, MethodsWithSpectra, RecordInfo, \
@@ -16,12 +18,39 @@ PARTIAL_IDENTIFIER_SEARCH_FIELDS = [
     AdditionalSubstanceInfo.literature_count, AdditionalSubstanceInfo.patent_count
 ]
 
+# Spectrum descriptions with everything after the last semicolon stripped off,
+# or null for descriptions that start with a '#'.
+SHORT_SPECTRUM_DESCRIPTION = case(
+    (RecordInfo.description.startswith("#"), None),
+    else_=func.regexp_replace(RecordInfo.description, "(^|;)[^;]*$", "")
+).label("short_description")
+
+# PDFs are sent to clients in pieces of this many bytes.
+PDF_CHUNK_SIZE = 1024 * 1024
+
+# Tables that store PDFs for each record type, along with the column used as
+# the PDFs' names.  Analytical QC spectrum PDFs are handled in pdf_table().
+PDF_TABLES = {
+    "fact sheet": (FactSheets, FactSheets.fact_sheet_name),
+    "method": (Methods, Methods.method_name),
+    "spectrum": (SpectrumPDFs, SpectrumPDFs.internal_id)
+}
+
+
+def any_of(column, values):
+    """
+    Builds a filter checking whether a column's value is in a list.  Unlike
+    `column.in_(values)`, the whole list is sent as one array parameter, so the
+    statement is the same no matter how long the list is.
+    """
+    return column == any_(bindparam(None, list(values), type_=ARRAY(column.type)))
+
 
 def additional_source_counts(dtxsids):
     """
     Pulls additional count data for a list of DTXSIDs.
     """
-    query = db.select(AdditionalSubstanceInfo).filter(AdditionalSubstanceInfo.dtxsid.in_(dtxsids))
+    query = db.select(AdditionalSubstanceInfo).filter(any_of(AdditionalSubstanceInfo.dtxsid, dtxsids))
     results = [c[0].get_row_contents() for c in db.session.execute(query).all()]
 
     seen_dtxsids = set([r["dtxsid"] for r in results])
@@ -56,14 +85,15 @@ def classyfire_for_dtxsid(dtxsid, full_info=False):
         return None
 
 
+@util.ttl_cache(max_entries=1)
 def database_summary():
     """
-    Retrieves the information from the database summary table.
+    Retrieves the information from the database summary table, aggregated
+    into a single dictionary by the database.
     """
-    query = db.select(DatabaseSummary)
-    results = [c[0].get_row_contents() for c in db.session.execute(query).all()]
-    result_dict = {r["field_name"]: r["info"] for r in results}
-    return result_dict
+    query = db.select(func.json_object_agg(DatabaseSummary.field_name, DatabaseSummary.info, type_=db.JSON))
+    result_dict = db.session.execute(query).scalar()
+    return result_dict or {}
 
 
 def formula_search(formula):
@@ -81,7 +111,7 @@ def functional_uses_for_dtxsids(dtxsid_list, include_substances_without_uses=Tru
     given values of None by default, though this can be changed with the
     `include_substances_without_uses` flag.
     """
-    query = db.select(FunctionalUseClasses).filter(FunctionalUseClasses.dtxsid.in_(dtxsid_list))
+    query = db.select(FunctionalUseClasses).filter(any_of(FunctionalUseClasses.dtxsid, dtxsid_list))
     results = [c[0].get_row_contents() for c in db.session.execute(query).all()]
     result_dict = {r["dtxsid"]: r["functional_classes"] for r in results}
     if include_substances_without_uses:
@@ -96,10 +126,10 @@ def ids_for_substances(dtxsids, record_type=None, additional_fields=[]):
     """
     Retrieves a list of record IDs that contain a given set of substances.
     """
-    query = db.select(Contents.internal_id, *additional_fields).join_from(Contents, RecordInfo, Contents.internal_id==RecordInfo.internal_id).filter(Contents.dtxsid.in_(dtxsids)).distinct()
+    query = db.select(Contents.internal_id, *additional_fields).join_from(Contents, RecordInfo, Contents.internal_id==RecordInfo.internal_id).filter(any_of(Contents.dtxsid, dtxsids)).distinct()
     if record_type is not None:
         query = query.filter(RecordInfo.record_type==record_type)
-    results = [c._asdict() for c in db.session.execute(query).all()]
+    results = [dict(c) for c in db.session.execute(query).mappings()]
     return results
 
 
@@ -121,28 +151,45 @@ def mass_range_search(lower_mass_limit, upper_mass_limit):
     return results
 
 
-def mass_spectra_for_substances(dtxsid_list, ms_level=None, additional_fields=[]):
+def mass_spectra_for_substances(dtxsid_list, ms_level=None, additional_fields=[], include_mass=False, mass_range=None):
     """
     Takes a list of DTXSIDs and returns all mass spectra associated with those
     DTXSIDs.  Additional fields from the Contents, RecordInfo, and Spectrum
-    tables can be added as needed.
+    tables can be added as needed; if include_mass is True, the substance's
+    monoisotopic mass is joined in as well.  If a (lower, upper) mass_range is
+    given, only substances with monoisotopic masses in that range are included.
+
+    Rows are streamed from the database in batches rather than loaded all at
+    once, so the returned iterator can only be iterated over once.  The rows
+    are read-only mappings; convert them to dictionaries if they need to be
+    modified or serialized.
     """
     query = db.select(Contents.dtxsid, RecordInfo.internal_id, RecordInfo.description, MassSpectra.spectrum, *additional_fields).filter(
-        (Contents.dtxsid.in_(dtxsid_list)) & (RecordInfo.data_type=="Mass Spectrum")
+        any_of(Contents.dtxsid, dtxsid_list) & (RecordInfo.data_type=="Mass Spectrum")
     ).join_from(
         Contents, RecordInfo, Contents.internal_id==RecordInfo.internal_id
     ).join_from(
         Contents, MassSpectra, Contents.internal_id==MassSpectra.internal_id
     )
+    if include_mass or (mass_range is not None):
+        query = query.join_from(Contents, Substances, Contents.dtxsid==Substances.dtxsid)
+    if include_mass:
+        query = query.add_columns(Substances.monoisotopic_mass)
+    if mass_range is not None:
+        query = query.filter(Substances.monoisotopic_mass.between(*mass_range))
     if ms_level is not None:
         query = query.filter(MassSpectra.ms_level==ms_level)
-    return [c._asdict() for c in db.session.execute(query).all()]
+    query = query.execution_options(stream_results=True)
+    return iter(db.session.execute(query).yield_per(500).mappings())
 
 
 def mass_spectrum_search(lower_mass_limit, upper_mass_limit, methodology=None):
     """
     Retrieves basic information on a set of spectra from the database,
     constrained by a mass range and an analytical methodology.
+
+    Like mass_spectra_for_substances(), rows are streamed from the database as
+    read-only mappings, so the returned iterator can only be iterated over once.
     """
     query = db.select(
             Substances.dtxsid, Substances.preferred_name, Contents.internal_id, RecordInfo.description, RecordInfo.source, RecordInfo.link,
@@ -158,8 +205,8 @@ def mass_spectrum_search(lower_mass_limit, upper_mass_limit, methodology=None):
         )
     if methodology:
         query = query.filter(RecordInfo.methodologies.any(methodology))
-    results = [c._asdict() for c in db.session.execute(query).all()]
-    return results
+    query = query.execution_options(stream_results=True)
+    return iter(db.session.execute(query).yield_per(500).mappings())
 
 
 def names_for_dtxsids(dtxsid_list):
@@ -167,55 +214,77 @@ def names_for_dtxsids(dtxsid_list):
     Creates a dictionary that maps a list of DTXSIDs to the EPA-preferred name
     for the substance.
     """
-    query = db.select(Substances.preferred_name, Substances.dtxsid).filter(Substances.dtxsid.in_(dtxsid_list))
-    results = [c._asdict() for c in db.session.execute(query).all()]
+    query = db.select(Substances.preferred_name, Substances.dtxsid).filter(any_of(Substances.dtxsid, dtxsid_list))
+    results = [dict(c) for c in db.session.execute(query).mappings()]
     names_for_dtxsids = {r["dtxsid"]:r["preferred_name"] for r in results}
     return names_for_dtxsids
 
 
-def pdf_by_id(internal_id, record_type):
+def pdf_table(internal_id, record_type):
     """
-    Retrieves a PDF from the database based on its internal ID, with the record
-    type indicating which table should be searched.  If no PDF is found, return
-    None.
+    Returns the table that stores PDFs for the given (lowercase) record type,
+    along with the column used as the PDFs' names, or None if the record type
+    is invalid.
     """
-    if record_type.lower() == "fact sheet":
-        query = db.select(FactSheets.pdf_data).filter(FactSheets.internal_id==internal_id)
-    elif record_type.lower() == "method":
-        query = db.select(Methods.pdf_data).filter(Methods.internal_id==internal_id)
-    elif record_type.lower() == "spectrum":
-        if internal_id.startswith("AnalyticalQC-"):
-            query = db.select(AnalyticalQC.pdf_data).filter(AnalyticalQC.internal_id==internal_id)
-        else:
-            query = db.select(SpectrumPDFs.pdf_data).filter(SpectrumPDFs.internal_id==internal_id)
-    else:
-        return f"Error: invalid record type {record_type}."
-    
-    data_row = db.session.execute(query).first()
-    if data_row is not None:
-        return data_row.pdf_data
-    else:
+    if (record_type == "spectrum") and internal_id.startswith("AnalyticalQC-"):
+        return AnalyticalQC, AnalyticalQC.filename
+    return PDF_TABLES.get(record_type)
+
+
+def pdf_size(internal_id, record_type):
+    """
+    Returns the size in bytes of a PDF in the database, based on its internal
+    ID, with the record type indicating which table should be searched.  If no
+    PDF is found or the record type is invalid, return None.
+    """
+    table_info = pdf_table(internal_id, record_type)
+    if table_info is None:
         return None
+    table, _ = table_info
+    query = db.select(func.octet_length(table.pdf_data)).filter(table.internal_id==internal_id)
+    return db.session.execute(query).scalar()
+
+
+def pdf_chunks(internal_id, record_type, size, chunk_size=PDF_CHUNK_SIZE):
+    """
+    Generator that yields the first `size` bytes of a PDF in the database in
+    pieces of `chunk_size` bytes.
+
+    The PDF is read in a single query through a server-side cursor and sliced
+    in place, rather than with one substr() query per piece -- the PDFs are
+    compressed by Postgres, so each substr() would decompress everything up to
+    its offset again.  If the PDF has been deleted by the time this runs,
+    nothing is yielded.
+    """
+    table_info = pdf_table(internal_id, record_type)
+    if table_info is None:
+        return
+    table, _ = table_info
+    query = db.select(table.pdf_data).filter(table.internal_id==internal_id)
+    pdf_data = db.session.execute(query.execution_options(stream_results=True)).scalar()
+    if pdf_data is None:
+        return
+    pdf_data = memoryview(pdf_data)[:size]
+    for offset in range(0, len(pdf_data), chunk_size):
+        yield bytes(pdf_data[offset:offset + chunk_size])
 
 
+@util.ttl_cache(max_entries=util.RECORD_CACHE_SIZE)
 def pdf_metadata(internal_id, record_type):
     """
     Single function for retrieving a PDF from the database along with the
     information that is always summoned alongside it -- metadata, a
     filename, and whether there are associated spectra.
     """
-    if record_type == "method":
-        query = db.select(Methods.method_name.label("pdf_name"), Methods.pdf_metadata, Methods.has_associated_spectra).filter(Methods.internal_id==internal_id)
-    elif record_type == "fact sheet":
-        query = db.select(FactSheets.fact_sheet_name.label("pdf_name"), FactSheets.pdf_metadata).filter(FactSheets.internal_id==internal_id)
-    elif record_type == "spectrum":
-        if internal_id.startswith("AnalyticalQC-"):
-            query = db.select(AnalyticalQC.filename.label("pdf_name"), AnalyticalQC.pdf_metadata).filter(AnalyticalQC.internal_id==internal_id)
-        else:
-            query = db.select(SpectrumPDFs.internal_id.label("pdf_name"), SpectrumPDFs.pdf_metadata).filter(SpectrumPDFs.internal_id==internal_id)
-    else:
+    table_info = pdf_table(internal_id, record_type)
+    if table_info is None:
         return {"error": f"Error: invalid record type {record_type}."}
-    
+    table, name_column = table_info
+    columns = [name_column.label("pdf_name"), table.pdf_metadata]
+    if table is Methods:
+        columns.append(Methods.has_associated_spectra)
+    query = db.select(*columns).filter(table.internal_id==internal_id)
+
     data_row = db.session.execute(query).first()
     if data_row is not None:
         data_row = data_row._asdict()
@@ -230,26 +299,29 @@ def pdf_metadata(internal_id, record_type):
 
 def record_counts_by_dtxsid(dtxsid_list):
     """
-    Gets counts of each type of record for each DTXSID in `dtxsid_list`.
+    Gets counts of each type of record for each DTXSID in `dtxsid_list`.  The
+    counts are collected into one JSON object per DTXSID by the database.
+    DTXSIDs without any records map to empty dictionaries.
     """
-    query = db.select(
-            Contents.dtxsid, RecordInfo.record_type, func.count(RecordInfo.internal_id)
+    type_counts = db.select(
+            Contents.dtxsid, RecordInfo.record_type, func.count(RecordInfo.internal_id).label("count")
         ).join_from(
             Contents, RecordInfo, Contents.internal_id==RecordInfo.internal_id
-        ).filter(Contents.dtxsid.in_(dtxsid_list)).group_by(Contents.dtxsid, RecordInfo.record_type)
-    results = [c._asdict() for c in db.session.execute(query).all()]
-    result_dict = defaultdict(dict)
-    for r in results:
-        result_dict[r["dtxsid"]].update({r["record_type"]: r["count"]})
-    return result_dict
+        ).filter(
+            any_of(Contents.dtxsid, dtxsid_list) & RecordInfo.record_type.isnot(None)
+        ).group_by(Contents.dtxsid, RecordInfo.record_type).subquery()
+    query = db.select(
+        type_counts.c.dtxsid, func.json_object_agg(type_counts.c.record_type, type_counts.c.count, type_=db.JSON)
+    ).group_by(type_counts.c.dtxsid)
+    return defaultdict(dict, db.session.execute(query).all())
 
 
 def substance_counts_by_record(internal_id_list):
     """
     Gets counts of the number of substances in a list of internal IDs.
     """
-    query = db.select(Contents.internal_id, func.count(Contents.dtxsid)).filter(Contents.internal_id.in_(internal_id_list)).group_by(Contents.internal_id)
-    return [c._asdict() for c in db.session.execute(query).all()]
+    query = db.select(Contents.internal_id, func.count(Contents.dtxsid)).filter(any_of(Contents.internal_id, internal_id_list)).group_by(Contents.internal_id)
+    return [dict(c) for c in db.session.execute(query).mappings()]
 
 
 def substances_for_ids(internal_ids, additional_fields=[]):
@@ -264,19 +336,47 @@ def substances_for_ids(internal_ids, additional_fields=[]):
     if type(internal_ids) == str:
         query = query.filter(Contents.internal_id==internal_ids)
     else:
-        query = query.filter(Contents.internal_id.in_(internal_ids)).distinct()
-    results = [c._asdict() for c in db.session.execute(query).all()]
+        query = query.filter(any_of(Contents.internal_id, internal_ids)).distinct()
+    results = [dict(c) for c in db.session.execute(query).mappings()]
     return results
 
 
 def substring_search(substring):
-    preferred_name_query = db.select(Substances, AdditionalSubstanceInfo).join_from(Substances, AdditionalSubstanceInfo, Substances.dtxsid==AdditionalSubstanceInfo.dtxsid, isouter=True).filter(Substances.preferred_name.ilike(f"%{substring}%"))
-    synonym_query = db.select(Synonyms, Substances, AdditionalSubstanceInfo).join_from(
+    """
+    Returns two lists of substances -- one where the preferred name contains
+    the given substring, and one where a synonym does (with the matching
+    synonym included).  Both searches are run as a single query.
+    """
+    substance_columns = [
+        Substances.dtxsid, Substances.dtxcid, Substances.casrn, Substances.jchem_inchikey,
+        Substances.indigo_inchikey, Substances.preferred_name, Substances.molecular_formula,
+        Substances.monoisotopic_mass, Substances.image_in_comptox, Substances.smiles
+    ]
+    additional_info_columns = [
+        AdditionalSubstanceInfo.source_count, AdditionalSubstanceInfo.patent_count,
+        AdditionalSubstanceInfo.literature_count, AdditionalSubstanceInfo.pubmed_count
+    ]
+    matched_columns = [
+        *substance_columns, AdditionalSubstanceInfo.dtxsid.label("additional_info_dtxsid"), *additional_info_columns
+    ]
+    preferred_name_query = db.select(literal("n").label("match_source"), null().label("synonym"), *matched_columns).join_from(
+            Substances, AdditionalSubstanceInfo, Substances.dtxsid==AdditionalSubstanceInfo.dtxsid, isouter=True
+        ).filter(Substances.preferred_name.ilike(f"%{substring}%"))
+    synonym_query = db.select(literal("s").label("match_source"), Synonyms.synonym, *matched_columns).join_from(
             Synonyms, Substances, Synonyms.dtxsid==Substances.dtxsid
         ).join_from(
             Substances, AdditionalSubstanceInfo, Substances.dtxsid==AdditionalSubstanceInfo.dtxsid, isouter=True
         ).filter(Synonyms.synonym.ilike(f"%{substring}%"))
-    
-    preferred_names = [r[0].get_row_contents() | (r[1].get_row_contents() if r[1] else EMPTY_ADDITIONAL_INFO_ROW) for r in db.session.execute(preferred_name_query).all()]
-    synonyms = [r[0].get_row_contents() | r[1].get_row_contents() | (r[2].get_row_contents() if r[2] else EMPTY_ADDITIONAL_INFO_ROW) for r in db.session.execute(synonym_query).all()]
+
+    preferred_names, synonyms = [], []
+    for r in db.session.execute(union_all(preferred_name_query, synonym_query)).mappings():
+        row = {c.name: r[c.name] for c in substance_columns}
+        if r["additional_info_dtxsid"] is not None:
+            row |= {c.name: r[c.name] for c in additional_info_columns}
+        else:
+            row |= EMPTY_ADDITIONAL_INFO_ROW
+        if r["match_source"] == "n":
+            preferred_names.append(row)
+        else:
+            synonyms.append({"synonym": r["synonym"], **row})
     return preferred_names, synonyms
\ No newline at end of file
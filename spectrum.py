@@ -1,7 +1,6 @@
-from collections import defaultdict
 from math import log
 
-import pandas as pd
+import numpy as np
 
 
 def calculate_entropy_similarity(spectrum_a, spectrum_b, da_error=None, ppm_error=None):
@@ -11,21 +10,58 @@ def calculate_entropy_similarity(spectrum_a, spectrum_b, da_error=None, ppm_erro
     if (da_error is None) and (ppm_error is None):
         da_error = 0.05
 
-    spectrum_a = normalize_spectrum(spectrum_a)
-    spectrum_b = normalize_spectrum(spectrum_b)
+    preprocessed_a = preprocess_spectrum(spectrum_a, da_error, ppm_error)
+    preprocessed_b = preprocess_spectrum(spectrum_b, da_error, ppm_error)
+    return calculate_preprocessed_entropy_similarity(preprocessed_a, preprocessed_b, da_error, ppm_error)
 
-    combined_dict = defaultdict(float)
-    for mz, i in spectrum_a + spectrum_b:
-        combined_dict[mz] += i
-    combined_spectrum = [list(i) for i in list(combined_dict.items())]
 
-    spectrum_a = combine_peaks(spectrum_a, da_error, ppm_error)
-    spectrum_b = combine_peaks(spectrum_b, da_error, ppm_error)
-    combined_spectrum = combine_peaks(combined_spectrum, da_error, ppm_error)
+def calculate_intensity_entropy(intensities):
+    """
+    Calculates the spectral entropy from an array of a spectrum's intensities.
+    """
+    scaled_intensities = intensities / intensities.sum()
+    return float(-np.sum(scaled_intensities * np.log(scaled_intensities)))
+
+
+def calculate_preprocessed_entropy_similarity(preprocessed_a, preprocessed_b, da_error=None, ppm_error=None):
+    """
+    Calculates the entropy similarity for two spectra that have already been
+    run through preprocess_spectrum().  The mass windows should be the same as
+    the ones used for preprocessing.
+
+    A spectrum with no peaks has nothing in common with any other spectrum,
+    so its similarity is always 0.  (Before the early exit below, the formula
+    gave 1 - S/log(4) for the other spectrum's entropy S, which was an
+    artifact of merging with nothing.)  The endpoints reject empty spectra
+    through validate_spectrum() before this is reached.
+    """
+    if (da_error is None) and (ppm_error is None):
+        da_error = 0.05
+
+    (mz_a, intensities_a), _, sA = preprocessed_a
+    (mz_b, intensities_b), _, sB = preprocessed_b
+
+    # Peaks only get merged if they're within a window of a common peak, so if
+    # nothing in either spectrum is within two windows of the other, none of
+    # their peaks will be merged and the similarity is zero.
+    if (len(mz_a) == 0) or (len(mz_b) == 0):
+        return 0
+    if da_error and da_error > 0:
+        max_mz_window_size = da_error
+    elif ppm_error and ppm_error > 0:
+        max_mz_window_size = ppm_error * 1e-6 * max(mz_a[-1], mz_b[-1])
+    else:
+        max_mz_window_size = 0
+    if not peaks_overlap(mz_a, mz_b, 2 * max_mz_window_size + 1e-9):
+        return 0
+
+    # merge the two normalized spectra, summing the intensities of peaks with
+    # identical m/z values
+    merged_mz, merged_index = np.unique(np.concatenate((mz_a, mz_b)), return_inverse=True)
+    merged_intensities = np.bincount(merged_index, weights=np.concatenate((intensities_a, intensities_b)))
+    _, combined_intensities = combine_peak_arrays(merged_mz, merged_intensities, da_error, ppm_error)
 
-    sAB = calculate_spectral_entropy(combined_spectrum)
-    sA = calculate_spectral_entropy(spectrum_a)
-    sB = calculate_spectral_entropy(spectrum_b)
+    sAB = calculate_intensity_entropy(combined_intensities)
     similarity =  1 - (2 * sAB - sA - sB)/log(4)
 
     # This is to try to keep floating point errors from sending back tiny
@@ -40,9 +76,8 @@ def calculate_spectral_entropy(spectrum):
     """
     Calculates the spectral entropy for a single spectrum.
     """
-    total_intensity = sum([i for mz, i in spectrum])
-    scaled_intensities = [i/total_intensity for mz, i in spectrum]
-    return sum([-1 * i * log(i) for i in scaled_intensities])
+    _, intensities = spectrum_to_arrays(spectrum)
+    return calculate_intensity_entropy(intensities)
 
 
 def cosine_similarity(spectrum1, spectrum2):
@@ -51,35 +86,51 @@ def cosine_similarity(spectrum1, spectrum2):
     which is in turn based on the paper "Optimization & Testing of Mass
     Spectral Library Search Algorithms for Compound Identification" by
     Stein & Scott.
+
+    Peaks are paired up by nominal mass -- every peak is paired with each peak
+    in the other spectrum with the same rounded m/z, and peaks with no partner
+    are paired with an intensity of zero.  The closest pairings are then kept
+    such that each m/z value from either spectrum is only used once; ties in
+    m/z distance go to the pairing whose peaks come first in the spectra.
+    Returns 0 if either spectrum is empty or has no nonzero intensities.
     """
-    df1 = pd.DataFrame(spectrum1, columns=["mz", "intensity"])
-    df2 = pd.DataFrame(spectrum2, columns=["mz", "intensity"])
-    df1["binned_mz"] = df1["mz"].apply(round, ndigits=0)
-    df2["binned_mz"] = df2["mz"].apply(round, ndigits=0)
-    merged_df = pd.merge(df1, df2, on="binned_mz", how="outer")
-
-    # The merge renames the mz columns to keep them distinct -- mz_x is
-    # the mz column from df1, and mz_y is from df2
-    merged_df["mz_delta"] = abs(merged_df["mz_x"] - merged_df["mz_y"])
-    merged_df["mz_x"].fillna(merged_df["mz_y"], inplace=True)
-    merged_df["mz_y"].fillna(merged_df["mz_x"], inplace=True)
-    merged_df.fillna(0, inplace=True)
-    merged_df.sort_values(by="mz_delta", ascending=True, inplace=True)
-
-    aligned_df = merged_df[(~merged_df.duplicated(subset="mz_x", keep="first")) & (~merged_df.duplicated(subset="mz_y", keep="first"))].copy()
-    aligned_df.drop(["binned_mz", "mz_delta"], axis=1, inplace=True)
-    aligned_df.sort_values(by="mz_x", inplace=True)
-    aligned_df.reset_index(drop=True, inplace=True)
+    mz_a, intensities_a = np.asarray(spectrum1, dtype=np.float64).reshape(-1, 2).T
+    mz_b, intensities_b = np.asarray(spectrum2, dtype=np.float64).reshape(-1, 2).T
+    bins_a, bins_b = np.round(mz_a), np.round(mz_b)
+
+    # find the range of peaks in the other spectrum sharing each peak's nominal mass
+    order_b = np.argsort(bins_b, kind="stable")
+    starts = np.searchsorted(bins_b[order_b], bins_a, side="left")
+    counts = np.searchsorted(bins_b[order_b], bins_a, side="right") - starts
+    pairs_a = np.repeat(np.arange(len(mz_a)), counts)
+    offsets = np.arange(len(pairs_a)) - np.repeat(np.cumsum(counts) - counts, counts)
+    pairs_b = order_b[np.repeat(starts, counts) + offsets]
+    unmatched_a = counts == 0
+    unmatched_b = ~np.isin(bins_b, bins_a)
+
+    # one row per pairing, followed by the unmatched peaks of each spectrum
+    mz_x = np.concatenate((mz_a[pairs_a], mz_a[unmatched_a], mz_b[unmatched_b]))
+    mz_y = np.concatenate((mz_b[pairs_b], mz_a[unmatched_a], mz_b[unmatched_b]))
+    intensity_x = np.concatenate((intensities_a[pairs_a], intensities_a[unmatched_a], np.zeros(unmatched_b.sum())))
+    intensity_y = np.concatenate((intensities_b[pairs_b], np.zeros(unmatched_a.sum()), intensities_b[unmatched_b]))
+
+    # keep the closest pairings, with each m/z value from either spectrum used once
+    order = np.argsort(np.abs(mz_x - mz_y), kind="stable")
+    first_x = np.zeros(len(order), dtype=bool)
+    first_y = np.zeros(len(order), dtype=bool)
+    first_x[np.unique(mz_x[order], return_index=True)[1]] = True
+    first_y[np.unique(mz_y[order], return_index=True)[1]] = True
+    aligned = order[first_x & first_y]
 
     # m and n are values found by trial and error in Stein & Scott's
     # paper to be a useful adjustment to the calculation
     m, n = 0.5, 0.5
-    aligned_df["weighted_x"] = aligned_df["mz_x"].pow(m) * aligned_df["intensity_x"].pow(n)
-    aligned_df["weighted_y"] = aligned_df["mz_y"].pow(m) * aligned_df["intensity_y"].pow(n)
-    numerator = sum(aligned_df["weighted_x"] * aligned_df["weighted_y"]) ** 2
-    denominator = sum(aligned_df["weighted_x"].pow(2)) * sum(aligned_df["weighted_y"].pow(2))
-    return numerator/denominator
-
+    weighted_x = mz_x[aligned] ** m * intensity_x[aligned] ** n
+    weighted_y = mz_y[aligned] ** m * intensity_y[aligned] ** n
+    denominator = np.sum(weighted_x ** 2) * np.sum(weighted_y ** 2)
+    if denominator == 0:
+        return 0
+    return float(np.sum(weighted_x * weighted_y) ** 2 / denominator)
 
 
 def combine_peaks(spectrum, da_error=0.05, ppm_error=None):
@@ -89,32 +140,62 @@ def combine_peaks(spectrum, da_error=0.05, ppm_error=None):
     intensity peak that hasn't been merged, combining sufficiently close peaks,
     and repeating until all peaks have been considered
     """
-    # Create a copy of the spectrum & sort it in order of increasing m/z.
-    spectrum_copy = spectrum.copy()
-    spectrum_copy.sort()
+    mz, intensities = spectrum_to_arrays(spectrum)
+    mz, intensities = combine_peak_arrays(mz, intensities, da_error, ppm_error)
+    return np.column_stack((mz, intensities)).tolist()
+
+
+def combine_peak_arrays(mz, intensities, da_error=0.05, ppm_error=None):
+    """
+    Does the work of combine_peaks() on a spectrum that has been split into
+    arrays of m/z values and intensities by spectrum_to_arrays().  Returns the
+    combined spectrum in the same format.
+    """
+    # either use the absolute error (da_error) or parts per million of the peak mz (ppm_error)
+    # if neither input is good, assume no delta, though this should probably be improved later
+    if da_error and da_error > 0:
+        mz_window_sizes = np.full(len(mz), da_error, dtype=np.float64)
+    elif ppm_error and ppm_error > 0:
+        mz_window_sizes = ppm_error * 1e-6 * mz
+    else:
+        mz_window_sizes = np.zeros(len(mz))
+
+    # Usually no two neighboring peaks are close enough to merge, in which case
+    # combining the peaks just drops the empty ones.
+    mz_deltas = np.diff(mz)
+    if np.all((mz_deltas > mz_window_sizes[:-1]) & (mz_deltas > mz_window_sizes[1:])):
+        has_intensity = intensities > 0
+        return mz[has_intensity], intensities[has_intensity]
+
+    # A peak can only be merged with neighbors that are within the widest
+    # window of it, so peaks without one are left alone and only the rest go
+    # through the merging loop below.
+    close_to_next = mz_deltas <= mz_window_sizes.max()
+    has_neighbor = np.zeros(len(mz), dtype=bool)
+    has_neighbor[:-1] |= close_to_next
+    has_neighbor[1:] |= close_to_next
+    isolated = ~has_neighbor & (intensities > 0)
 
     # Find order of elements by decreasing intensity.
-    intensity_order = [i[0] for i in sorted(enumerate(spectrum_copy), key=lambda x: -x[1][1])]
+    intensity_order = np.argsort(-intensities, kind="stable")
+    intensity_order = intensity_order[has_neighbor[intensity_order]].tolist()
 
-    # Start a new, empty array, called spec_new.
-    spec_new = []
+    # Working on plain lists is faster than indexing into the arrays one
+    # element at a time; the intensities get zeroed out as they're merged.
+    mz_list = mz.tolist()
+    intensity_list = intensities.tolist()
+    mz_window_sizes = mz_window_sizes.tolist()
+    new_mz, new_intensities = [], []
 
     for i in intensity_order:
-        mz, intensity = spectrum_copy[i]
+        peak_mz, intensity = mz_list[i], intensity_list[i]
         if intensity > 0:
-            # either use the absolute error (da_error) or parts per million of the peak mz (ppm_error)
-            # if neither input is good, assume no delta, though this should probably be improved later
-            if da_error and da_error > 0:
-                mz_window_size = da_error
-            elif ppm_error > 0:
-                mz_window_size = ppm_error * 1e-6 * mz
-            else:
-                mz_window_size = 0
+            mz_window_size = mz_window_sizes[i]
 
             # find lowest mz within window
             lowest_mz_peak_index = i
             while lowest_mz_peak_index > 0:
-                mz_delta = mz - spectrum_copy[lowest_mz_peak_index-1][0]
+                mz_delta = peak_mz - mz_list[lowest_mz_peak_index-1]
                 if mz_delta <= mz_window_size:
                     lowest_mz_peak_index -= 1
                 else:
@@ -122,8 +203,8 @@ def combine_peaks(spectrum, da_error=0.05, ppm_error=None):
             
             # find highest mz within window
             highest_mz_peak_index = i
-            while highest_mz_peak_index < len(spectrum_copy)-1:
-                mz_delta = spectrum_copy[highest_mz_peak_index+1][0] - mz
+            while highest_mz_peak_index < len(mz_list)-1:
+                mz_delta = mz_list[highest_mz_peak_index+1] - peak_mz
                 if mz_delta <= mz_window_size:
                     highest_mz_peak_index += 1
                 else:
@@ -132,23 +213,97 @@ def combine_peaks(spectrum, da_error=0.05, ppm_error=None):
             intensity_sum = 0
             intensity_weighted_sum = 0
             for idx in range(lowest_mz_peak_index, highest_mz_peak_index+1):
-                intensity_sum += spectrum_copy[idx][1]
-                intensity_weighted_sum += spectrum_copy[idx][0] * spectrum_copy[idx][1]
-                spectrum_copy[idx][1] = 0
+                intensity_sum += intensity_list[idx]
+                intensity_weighted_sum += mz_list[idx] * intensity_list[idx]
+                intensity_list[idx] = 0
+
+            new_mz.append(intensity_weighted_sum/intensity_sum)
+            new_intensities.append(intensity_sum)
+
+    # isolated peaks are computed the same way as a merge of a single peak
+    new_mz = np.concatenate((new_mz, mz[isolated] * intensities[isolated] / intensities[isolated]))
+    new_intensities = np.concatenate((new_intensities, intensities[isolated]))
+    new_order = np.lexsort((new_intensities, new_mz))
+    return new_mz[new_order], new_intensities[new_order]
+
+
+def entropy_similarities(library_spectrum, user_preprocessed, da_error=None, ppm_error=None):
+    """
+    Calculates the entropy similarity between a single database spectrum and
+    each of a list of preprocessed user spectra.  Like score_library_spectrum(),
+    this can be run in a separate worker process.
+    """
+    library_preprocessed = preprocess_spectrum(library_spectrum, da_error, ppm_error)
+    return [calculate_preprocessed_entropy_similarity(library_preprocessed, up, da_error, ppm_error)
+            for up in user_preprocessed]
+
+
+def peaks_overlap(mz_a, mz_b, mz_tolerance):
+    """
+    Checks whether any peak in one m/z-sorted array is within the given
+    tolerance of a peak in the other.
+    """
+    insertion_points = np.searchsorted(mz_b, mz_a)
+    lower_neighbors = mz_b[np.maximum(insertion_points - 1, 0)]
+    upper_neighbors = mz_b[np.minimum(insertion_points, len(mz_b) - 1)]
+    return bool(np.any((np.abs(mz_a - lower_neighbors) <= mz_tolerance) |
+                       (np.abs(upper_neighbors - mz_a) <= mz_tolerance)))
+
 
-            spec_new.append([intensity_weighted_sum/intensity_sum, intensity_sum])
-    
-    spec_new.sort()
-    return spec_new
+def preprocess_spectrum(spectrum, da_error=None, ppm_error=None):
+    """
+    Does the parts of the entropy similarity calculation that only depend on a
+    single spectrum -- normalizing it, combining its peaks, and calculating its
+    spectral entropy.  Useful when one spectrum is being compared against many
+    others, since this only needs to be done once for it.
 
+    Returns a tuple of the normalized spectrum, the combined spectrum, and the
+    spectral entropy of the combined spectrum.  Both spectra are in the form
+    of (m/z, intensity) array pairs, as returned by spectrum_to_arrays().
+    """
+    if (da_error is None) and (ppm_error is None):
+        da_error = 0.05
 
-def normalize_spectrum(spectrum):
+    mz, intensities = spectrum_to_arrays(spectrum)
+    intensities = intensities / intensities.sum()
+    combined_mz, combined_intensities = combine_peak_arrays(mz, intensities, da_error, ppm_error)
+    return (mz, intensities), (combined_mz, combined_intensities), calculate_intensity_entropy(combined_intensities)
+
+
+def score_library_spectrum(library_spectrum, monoisotopic_mass, user_spectra, user_preprocessed, min_intensity=0,
+                           da_error=None, ppm_error=None):
     """
-    Rescales a spectrum so that the max intensity is 1.
+    Compares a single database spectrum against a list of user spectra, for
+    the all_similarities_by_dtxsid endpoint.  Peaks above the substance's
+    monoisotopic mass (minus a proton or so) and peaks below the minimum
+    intensity are dropped from the database spectrum first.
+
+    This doesn't touch the database or the request, so it can be run in a
+    separate worker process.  Returns None if no peaks survive the filtering;
+    otherwise, returns a tuple of a dictionary of information about the
+    filtered spectrum and a list of (entropy similarity, cosine similarity)
+    pairs, one for each user spectrum.
     """
-    max_intensity = sum([i for mz, i in spectrum])
-    normalized_spectrum = [[mz, i/max_intensity] for mz, i in spectrum]
-    return normalized_spectrum
+    peaks = np.asarray(library_spectrum, dtype=np.float64).reshape(-1, 2)
+    filtered_peaks = peaks[(peaks[:, 0] < (monoisotopic_mass - 1.5)) & (peaks[:, 1] > min_intensity)]
+    if len(filtered_peaks) == 0:
+        return None
+
+    combined_mz, combined_intensities = combine_peak_arrays(*spectrum_to_arrays(filtered_peaks))
+    combined_spectrum = np.column_stack((combined_mz, combined_intensities))
+    spectral_entropy = calculate_intensity_entropy(combined_intensities)
+    normalized_entropy = spectral_entropy / len(combined_spectrum)
+    information = {"Points": len(filtered_peaks), "Spectral Entropy": spectral_entropy,
+                   "Normalized Entropy": normalized_entropy,
+                   "Rating": spectrum_rating(spectral_entropy, normalized_entropy)}
+
+    library_preprocessed = preprocess_spectrum(combined_spectrum, da_error, ppm_error)
+    similarities = [
+        (calculate_preprocessed_entropy_similarity(up, library_preprocessed, da_error, ppm_error),
+         cosine_similarity(us, combined_spectrum))
+        for us, up in zip(user_spectra, user_preprocessed)
+    ]
+    return information, similarities
 
 
 def spectrum_rating(spectral_entropy, normalized_entropy):
@@ -164,9 +319,21 @@ def spectrum_rating(spectral_entropy, normalized_entropy):
         return "Clean"
 
 
+def spectrum_to_arrays(spectrum):
+    """
+    Splits a spectrum from a list of [m/z, intensity] pairs into separate
+    arrays of m/z values and intensities, sorted in order of increasing m/z.
+    """
+    peaks = np.array(spectrum, dtype=np.float64).reshape(-1, 2)
+    mz_order = np.lexsort((peaks[:, 1], peaks[:, 0]))
+    return peaks[mz_order, 0], peaks[mz_order, 1]
+
+
 def validate_spectrum(spectrum):
     if type(spectrum) is not list:
         raise ValueError("Spectrum format is incorrect -- submitted value is not a list.")
+    if len(spectrum) == 0:
+        raise ValueError("Spectrum format is incorrect -- the spectrum has no peaks.")
     if not all((type(x) is tuple or type(x) is list) for x in spectrum):
         raise ValueError("Spectrum format is incorrect -- at least one element in the list of peaks is not itself a list.")
     if not all(len(x) == 2 for x in spectrum):
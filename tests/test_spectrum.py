@@ -0,0 +1,82 @@
+from math import sqrt
+import unittest
+
+import spectrum
+
+SPECTRUM_A = [[100.0, 10.0], [150.0, 20.0], [200.0, 5.0]]
+SPECTRUM_B = [[100.01, 12.0], [150.02, 18.0], [250.0, 4.0]]
+FAR_SPECTRUM = [[300.0, 1.0], [400.0, 1.0]]
+
+
+class EntropySimilarityTests(unittest.TestCase):
+    def test_known_similarities(self):
+        # reference values from the original pandas-based implementation
+        self.assertAlmostEqual(spectrum.calculate_entropy_similarity(SPECTRUM_A, SPECTRUM_B), 0.8666123003293327,
+                               places=12)
+        self.assertAlmostEqual(spectrum.calculate_entropy_similarity(SPECTRUM_A, SPECTRUM_B, ppm_error=200),
+                               0.8666123003293327, places=12)
+
+    def test_identical_spectra(self):
+        self.assertAlmostEqual(spectrum.calculate_entropy_similarity(SPECTRUM_A, SPECTRUM_A), 1.0)
+
+    def test_spectra_without_overlap(self):
+        self.assertEqual(spectrum.calculate_entropy_similarity(SPECTRUM_A, FAR_SPECTRUM), 0)
+
+    def test_empty_spectrum_has_no_similarity(self):
+        # the original implementation returned 1 - S/log(4) here, an artifact of merging with nothing
+        self.assertEqual(spectrum.calculate_entropy_similarity([], [[100, 1], [150, 2]]), 0)
+        self.assertEqual(spectrum.calculate_entropy_similarity([[100, 1], [150, 2]], []), 0)
+
+
+class CosineSimilarityTests(unittest.TestCase):
+    def test_known_similarity(self):
+        # reference value from the original pandas-based implementation
+        self.assertAlmostEqual(spectrum.cosine_similarity(SPECTRUM_A, SPECTRUM_B), 0.6341138161045943, places=12)
+
+    def test_identical_spectra_with_tied_intensities(self):
+        tied = [[100.0, 5.0], [101.0, 5.0], [102.0, 5.0]]
+        self.assertAlmostEqual(spectrum.cosine_similarity(tied, tied), 1.0)
+
+    def test_unmatched_peaks_count_against_similarity(self):
+        # weighted vectors are (10, 0) and (10, sqrt(150))
+        self.assertAlmostEqual(spectrum.cosine_similarity([[100, 1]], [[100, 1], [150, 1]]), 0.4)
+
+    def test_duplicate_mz_values_are_only_used_once(self):
+        # both peaks at m/z 100 pair with the single peak at 100 equally well; only the first is kept
+        self.assertAlmostEqual(spectrum.cosine_similarity([[100, 4], [100, 9], [200, 1]], [[100, 1], [200, 1]]),
+                               spectrum.cosine_similarity([[100, 4], [200, 1]], [[100, 1], [200, 1]]))
+
+    def test_tied_distances_go_to_the_first_listed_peak(self):
+        # 99.75 and 100.25 are both 0.25 away from 100; the first listed one is paired
+        similarity = spectrum.cosine_similarity([[100.0, 1], [200.0, 1]], [[99.75, 4], [100.25, 9], [200.0, 1]])
+        weighted_x = [sqrt(100.0), sqrt(200.0)]
+        weighted_y = [sqrt(99.75) * 2, sqrt(200.0)]
+        expected = (sum(x * y for x, y in zip(weighted_x, weighted_y)) ** 2 /
+                    (sum(x ** 2 for x in weighted_x) * sum(y ** 2 for y in weighted_y)))
+        self.assertAlmostEqual(similarity, expected)
+        self.assertAlmostEqual(similarity, 0.8892595293364092)
+
+    def test_empty_or_zero_spectra(self):
+        self.assertEqual(spectrum.cosine_similarity([], [[100, 1]]), 0)
+        self.assertEqual(spectrum.cosine_similarity([[100, 1]], []), 0)
+        self.assertEqual(spectrum.cosine_similarity([], []), 0)
+        self.assertEqual(spectrum.cosine_similarity([[100, 0]], [[100, 0]]), 0)
+
+
+class ValidateSpectrumTests(unittest.TestCase):
+    def test_valid_spectrum(self):
+        spectrum.validate_spectrum(SPECTRUM_A)
+
+    def test_empty_spectrum_is_rejected(self):
+        with self.assertRaisesRegex(ValueError, "no peaks"):
+            spectrum.validate_spectrum([])
+
+    def test_malformed_peaks_are_rejected(self):
+        with self.assertRaises(ValueError):
+            spectrum.validate_spectrum([[100.0]])
+        with self.assertRaises(ValueError):
+            spectrum.validate_spectrum([[100.0, "x"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
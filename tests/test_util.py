@@ -0,0 +1,123 @@
+import random
+import threading
+import unittest
+from unittest import mock
+
+import util
+
+
+class TTLCacheTests(unittest.TestCase):
+    def test_values_are_cached_until_they_expire(self):
+        calls = []
+
+        @util.ttl_cache(seconds=10)
+        def double(x):
+            calls.append(x)
+            return 2 * x
+
+        with mock.patch("util.time.monotonic", return_value=100.0):
+            self.assertEqual(double(3), 6)
+            self.assertEqual(double(3), 6)
+        self.assertEqual(calls, [3])
+
+        with mock.patch("util.time.monotonic", return_value=111.0):
+            self.assertEqual(double(3), 6)
+        self.assertEqual(calls, [3, 3])
+
+    def test_list_arguments_are_usable_as_keys(self):
+        @util.ttl_cache()
+        def total(values):
+            return sum(values)
+
+        self.assertEqual(total([1, 2, 3]), 6)
+        self.assertEqual(total(values=[1, 2]), 3)
+
+    def test_none_results_can_be_left_uncached(self):
+        calls = []
+
+        @util.ttl_cache(cache_none=False)
+        def lookup(x):
+            calls.append(x)
+            return None
+
+        lookup(1)
+        lookup(1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        calls = []
+
+        @util.ttl_cache(max_entries=2)
+        def identity(x):
+            calls.append(x)
+            return x
+
+        identity(1)
+        identity(2)
+        identity(1)  # 2 is now the least recently used
+        identity(3)
+        identity(1)
+        self.assertEqual(calls, [1, 2, 3])
+        identity(2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+
+    def test_expired_entries_are_purged_before_live_ones(self):
+        calls = []
+
+        @util.ttl_cache(seconds=10, max_entries=2)
+        def identity(x):
+            calls.append(x)
+            return x
+
+        with mock.patch("util.time.monotonic", return_value=100.0):
+            identity(1)
+        with mock.patch("util.time.monotonic", return_value=105.0):
+            identity(2)
+            identity(1)  # still fresh, and now the most recently used
+        with mock.patch("util.time.monotonic", return_value=112.0):
+            identity(3)  # 1 has expired, so 2 survives even though it's least recently used
+            identity(2)
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_cache_clear(self):
+        calls = []
+
+        @util.ttl_cache()
+        def identity(x):
+            calls.append(x)
+            return x
+
+        identity(1)
+        identity.cache_clear()
+        identity(1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_concurrent_access(self):
+        @util.ttl_cache(seconds=0.001, max_entries=8)
+        def square(x):
+            return x * x
+
+        errors = []
+        start = threading.Barrier(16)
+
+        def hammer(seed):
+            rng = random.Random(seed)
+            start.wait()
+            try:
+                for _ in range(5000):
+                    x = rng.randrange(64)
+                    if square(x) != x * x:
+                        errors.append(f"wrong value for {x}")
+            except Exception as e:
+                errors.append(repr(e))
+
+        threads = [threading.Thread(target=hammer, args=(i,)) for i in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,24 @@
+from collections import OrderedDict
 from copy import deepcopy
 import csv
+from functools import wraps
 import io
+import os
 import re
+import threading
+import time
 
 import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+
+CACHE_TTL = int(os.environ.get("AMOS_CACHE_TTL", 600))
+RECORD_CACHE_SIZE = int(os.environ.get("AMOS_RECORD_CACHE_SIZE", 4096))
+THIN_SIDE = Side(style="thin")
+ISO_DATE_REGEX = re.compile("^[0-9]{4}-[01][0-9]-[0-3][0-9]$")
+YEAR_REGEX = re.compile("^[0-9]{4}$")
+SLASH_DATE_REGEX = re.compile("^([0-9]+/)?[0-9]+/[0-9]{4}$")
 
 def clean_year(year_value):
     """
@@ -27,11 +42,11 @@ def clean_year(year_value):
     """
     if year_value is None:
         return None
-    elif re.match("^[0-9]{4}-[01][0-9]-[0-3][0-9]$", year_value):
+    elif ISO_DATE_REGEX.match(year_value):
         return int(year_value[:4])
-    elif re.match("^[0-9]{4}$", year_value):
+    elif YEAR_REGEX.match(year_value):
         return int(year_value)
-    elif re.match("^([0-9]+/)?[0-9]+/[0-9]{4}$", year_value):
+    elif SLASH_DATE_REGEX.match(year_value):
         return int(year_value[-4:])
     else:
         print(f"Issue with year value {year_value} -- unclear string format")
@@ -77,13 +92,33 @@ def make_excel_file(df_dict):
     """
     Constructs an in-memory Excel file using the specified dictionary of data
     frames.  Keys will be used as the sheet names while the values should be the
-    data frames to store.
+    data frames to store.  Small tables can be given as a tuple of column names
+    and a list of row tuples instead, to skip building a data frame.
+
+    The workbook is built in openpyxl's write-only mode, so rows are written
+    out as they're added instead of being kept as a full grid of cell objects.
+    Headers are styled the same way pandas' to_excel() styles them.
     """
+    workbook = Workbook(write_only=True)
+    for sheet_name, sheet_data in df_dict.items():
+        if isinstance(sheet_data, pd.DataFrame):
+            columns, rows = sheet_data.columns, sheet_data.itertuples(index=False, name=None)
+        else:
+            columns, rows = sheet_data
+        worksheet = workbook.create_sheet(sheet_name)
+        header = []
+        for column in columns:
+            cell = WriteOnlyCell(worksheet, value=str(column))
+            cell.font = Font(bold=True)
+            cell.border = Border(left=THIN_SIDE, right=THIN_SIDE, top=THIN_SIDE, bottom=THIN_SIDE)
+            cell.alignment = Alignment(horizontal="center", vertical="top")
+            header.append(cell)
+        worksheet.append(header)
+        for row in rows:
+            worksheet.append([None if pd.isna(v) else v for v in row])
+
     buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer) as writer:
-        for sheet_name, df in df_dict.items():
-            df.to_excel(writer, sheet_name=sheet_name, index=None)
-    
+    workbook.save(buffer)
     return buffer.getvalue()
 
 
@@ -104,3 +139,59 @@ def merge_substance_info_and_counts(substance_info, count_info):
         substance["fact_sheets"] = records.get("Fact Sheet", 0)
         substance["spectra"] = records.get("Spectrum", 0)
     return all_info
+
+
+def ttl_cache(seconds=CACHE_TTL, max_entries=1024, cache_none=True):
+    """
+    Decorator that keeps a function's return values in memory, keyed by its
+    arguments, for the given number of seconds.  List arguments are converted
+    to tuples so they can be used as keys.  Once there are more than
+    `max_entries` values stored, expired values are purged first, then the
+    least recently used ones are dropped.  If `cache_none` is False, None
+    results (e.g., from failed lookups) aren't stored.  The wrapped function
+    gets a `cache_clear()` method for emptying the cache.
+
+    The cache is safe to share between threads.  The wrapped function itself
+    runs outside the lock, so two threads missing on the same key at once may
+    both call it.
+
+    Cached values are shared between callers, so they should not be modified.
+    """
+    def decorator(function):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            key = (
+                tuple(tuple(a) if isinstance(a, list) else a for a in args),
+                tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in kwargs.items()))
+            )
+            with lock:
+                entry = cache.get(key)
+                if (entry is not None) and (time.monotonic() - entry[0] <= seconds):
+                    cache.move_to_end(key)
+                    return entry[1]
+
+            value = function(*args, **kwargs)
+            if (value is None) and not cache_none:
+                return value
+
+            with lock:
+                now = time.monotonic()
+                cache[key] = (now, value)
+                cache.move_to_end(key)
+                if len(cache) > max_entries:
+                    for expired_key in [k for k, (stored, _) in cache.items() if now - stored > seconds]:
+                        del cache[expired_key]
+                    while len(cache) > max_entries:
+                        cache.popitem(last=False)
+            return value
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator